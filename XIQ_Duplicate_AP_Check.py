@@ -1,225 +1,291 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 import os
-import json
-import time
-import pandas as pd
-from datetime import datetime, timedelta
 from pprint import pprint as pp
 from app.xiq_api import XIQ, APICallFailedException
 from app.logger import logger
+from app.check import DuplicateCheck
+from app.inventory_cache import InventoryCache
+from app.expiry_store import openExpiryStore, SqliteExpiryStore
+from app.tenants import runTenants
+from app.locations import selectShards
+from app.service import DuplicateCheckService
+from app.events import DeviceEventReceiver, LOOPBACK_HOSTS
+from app.duplicates import hostnameRules, checkDuplicateKeys
+from app.plan import planFromSnapshot, planDiff, savePlan, loadPlan
 logger = logging.getLogger("Duplicate_Check.Main")
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 
 token = ''
-if not token:
-    print("Please add a token to the script.")
-    print("Script is exiting...")
-    raise SystemExit
+# XIQ API address
+xiq_url = "https://api.extremecloudiq.com"
 
 # CCG Group Name
 ccg_group = "MarkedAsReplaced"
 
-# JSON for unmanaged devices with removal dates
+# Device fields compared to find duplicates, any of "hostname", "serial_number" and "mac_address"
+duplicate_keys = ["hostname"]
+# How hostnames are compared: ignore upper and lower case, and remove these regular expressions first,
+# for example [r"[-_.]old$"] to match "AP-01-old" with "AP-01"
+hostname_ignore_case = False
+hostname_strip_patterns = []
+
+# Number of device pages collected in parallel (1 collects one page at a time)
+page_concurrency = 5
+
+# Location type collected as one shard by --sharded and number of shards collected in parallel
+shard_type = "BUILDING"
+shard_concurrency = 4
+
+# Local inventory cache, refreshed incrementally between runs. Set to '' to always collect every device
+inventory_cache_file = f'{PATH}/inventory_cache.json'
+# Hours between full inventory collections when the cache is used
+full_resync_hours = 24
+
+# Number of device ids sent in each unmanage or delete call, and how many of those calls run at the same time
+batch_size = 100
+batch_concurrency = 4
+
+# The id of the CCG is kept here between runs so it does not have to be searched for
+ccg_cache_file = f'{PATH}/ccg_cache.json'
+
+# Store for unmanaged devices with removal dates. A path ending in .json keeps the devices in a JSON file
+expiry_store_file = f'{PATH}/monitor_unmanaged.db'
+# JSON for unmanaged devices from earlier versions, imported into the store once
 unmanaged_file = f'{PATH}/monitor_unmanaged.json'
 
-# Function to remove the expired devices
-def removeExpiredDevices(expired_device_list):
-    log_msg = f"The following devices will be deleted from XIQ as they have reached expiration date: {', '.join(map(str, expired_device_list))}"
-    logger.info(log_msg)
-    print(log_msg)
+# Journal of the changes of the current run. A run that is interrupted is finished from it by the next run
+journal_file = f'{PATH}/run_journal.jsonl'
+
+# Minutes between duplicate scans when running with --daemon
+scan_interval_minutes = 60
+
+# Port the daemon listens on for XIQ device event webhooks, 0 to only use the scans. Events are checked as they
+# arrive and the scans above stay as the full resync. With a secret, XIQ has to send "Authorization: Bearer <secret>".
+# Only the local machine can reach the default host, a secret is required to listen on any other address
+webhook_port = 0
+webhook_host = "127.0.0.1"
+webhook_path = "/xiq/events"
+webhook_secret = ''
+
+# JSON report of the API calls and phase durations of every run, and an optional Prometheus text file of the same
+report_file = f'{PATH}/run_report.json'
+prometheus_file = ''
+
+# Plan built by --plan from a snapshot, and run later with --apply
+plan_file = f'{PATH}/duplicate_plan.json'
+
+# Multi-tenant runs keep the state and logs of every tenant in its own folder under this one
+tenant_state_dir = f'{PATH}/tenants'
+# Number of tenants checked at the same time
+tenant_concurrency = 4
+
+# Settings above that SIGHUP re-reads from this file while running with --daemon. The webhook settings need a restart
+SETTINGS = ("token", "xiq_url", "ccg_group", "duplicate_keys", "hostname_ignore_case", "hostname_strip_patterns",
+            "page_concurrency", "shard_type", "shard_concurrency", "inventory_cache_file", "full_resync_hours",
+            "batch_size", "batch_concurrency", "ccg_cache_file", "expiry_store_file", "journal_file",
+            "scan_interval_minutes", "report_file", "prometheus_file")
+
+
+def checkTenants(config_file):
+    defaults = {
+        "ccg_group": ccg_group,
+        "page_concurrency": page_concurrency,
+        "batch_size": batch_size,
+        "batch_concurrency": batch_concurrency,
+        "full_resync_hours": full_resync_hours,
+        "use_inventory_cache": bool(inventory_cache_file),
+        "url": xiq_url,
+        "report": bool(report_file),
+        "prometheus": bool(prometheus_file),
+        "duplicate_keys": duplicate_keys,
+        "hostname_ignore_case": hostname_ignore_case,
+        "hostname_strip_patterns": hostname_strip_patterns
+    }
     try:
-        status = x.deleteDevices(expired_device_list)
-    except APICallFailedException as e:
-        print(f"API call failed to unmanage device with {str(e)}.")
+        summaries = runTenants(config_file, defaults, tenant_state_dir, max_workers=tenant_concurrency)
+    except (OSError, ValueError) as e:
+        print(f"Unable to load tenants from {config_file} - {e}")
         print("Script is exiting...")
         raise SystemExit
-    if status == "Success":
-        return status
-    else:
-        raise APICallFailedException(f"{status} to delete devices.")
+    if any(summary['status'] != 'success' for summary in summaries):
+        raise SystemExit(1)
+
 
-def checkCCG():
-    ## check if CCG group exists
+def findShards(x, locations=None):
     try:
-        ccg_found, ccg_info = x.checkForCCG(ccg_name=ccg_group)
+        tree = x.getLocationTree()
     except APICallFailedException as e:
-        print(f"API to find CCG {ccg_group} failed with {str(e)}.")
+        print(f"API to collect the location tree failed with {str(e)}.")
         print("Script is exiting...")
         raise SystemExit
-    return ccg_found, ccg_info
-
-#collect time info
-now = datetime.now()
-one_month = now + timedelta(days=30)
-current_time = time.mktime(now.timetuple())
-expire_time = time.mktime(one_month.timetuple())
-
-# check if json file exists
-if os.path.exists(unmanaged_file):
-    with open(unmanaged_file) as FH:
-        unmanaged_list = json.load(FH)
-else:
-    print(f"{unmanaged_file} file not found")
-    unmanaged_list = []
-
-json_file_change = False
-
-# Establish connection to XIQ
-x = XIQ(token=token)
-
-# collect all devices in XIQ
-devices = x.collectDevices()
-df = pd.DataFrame(devices)
-
-# filter out just duplicate named devices
-duplicated_rows = df[df.duplicated(subset='hostname', keep=False)]
-
-# check if CCG exists and get information
-ccg_found, ccg_info = checkCCG()
-
-# check for devices that time has run out
-expired_devices = [] # list for devices that are expired
-not_found_devices = [] # list for devices that no longer exist in XIQ
-for device in unmanaged_list:
-    if any( d['id'] == device['device_id'] for d in devices):
-        if device['expire_at'] <= current_time:
-            expired_devices.append(device['device_id'])
-    else:
-        logger.info(f"device {device['device_id']} no longer exists in XIQ. Device will be removed from json file.")
-        not_found_devices.append(device['device_id'])
-if expired_devices:
     try:
-        status = removeExpiredDevices(expired_devices)
-    except APICallFailedException as e:
-        logger.error(e)
+        location_ids = selectShards(tree, shard_type=shard_type, names=locations)
+    except ValueError as e:
         print(e)
         print("Script is exiting...")
         raise SystemExit
-    unmanaged_list = [device for device in unmanaged_list if device["device_id"] not in expired_devices]
-    ccg_info['device_ids'] = [device_id for device_id in ccg_info['device_ids'] if device_id not in expired_devices]
-    json_file_change = True
-
-if not_found_devices:
-    unmanaged_list = [device for device in unmanaged_list if device["device_id"] not in not_found_devices]
-    json_file_change = True
-
-if duplicated_rows.empty:
-    print("No Duplicate APs name found")
-    if ccg_found and not ccg_info['device_ids']:
-        # Delete ccg
-        try:
-            status = x.deleteCCG(ccg_info['id'])
-        except APICallFailedException as e:
-            logger.error(e)
-            print(e)
-            print("Script is exiting...")
-            raise SystemExit
-        log_msg = (f"deleted CCG {ccg_info['name']} as no devices exist.")
-        logger.info(log_msg)
-        print(log_msg)
-    raise SystemExit 
+    if not location_ids:
+        print(f"No {shard_type} locations found to collect devices from.")
+        print("Script is exiting...")
+        raise SystemExit
+    print(f"Collecting devices from {len(location_ids)} locations")
+    return location_ids
+
 
-unique_device_names = duplicated_rows['hostname'].unique()
+def duplicateSettings():
+    try:
+        checkDuplicateKeys(duplicate_keys)
+        return duplicate_keys, hostnameRules(hostname_ignore_case, hostname_strip_patterns)
+    except ValueError as e:
+        print(e)
+        print("Script is exiting...")
+        raise SystemExit
 
-device_ids = []
-new_devices = []
 
-for device_name in unique_device_names:
-    filt = (duplicated_rows['hostname'] == device_name) & \
-           ((duplicated_rows['connected'] == False) & (duplicated_rows['device_admin_state'] == 'MANAGED')) 
-    device_ids.extend(duplicated_rows.loc[filt,'id'].astype(int).tolist())
-        
-if device_ids:
-    # Unmanage offline duplicate devices 
+## Build the plan from a snapshot with no API calls, print it as a diff and save it for --apply
+def planSnapshot(snapshot_file):
+    keys, hostname_rules = duplicateSettings()
     try:
-        status = x.unmanageDevices(device_ids)
-    except APICallFailedException as e:
-        print(f"API call failed to unmanage device with {str(e)}.")
+        plan = planFromSnapshot(snapshot_file, duplicate_keys=keys, hostname_rules=hostname_rules)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Unable to read snapshot {snapshot_file} - {e}")
         print("Script is exiting...")
         raise SystemExit
+    print("\n".join(planDiff(plan)))
+    savePlan(plan_file, plan)
+    print(f"Plan saved to {plan_file}, run it with --apply {plan_file}")
+
+
+## Read the settings of this file again, the rest of the file is run too but only the settings are kept
+def reloadSettings():
+    namespace = {"__name__": "settings", "__file__": __file__}
+    with open(__file__) as FH:
+        exec(compile(FH.read(), __file__, "exec"), namespace)
+    globals().update({name: namespace[name] for name in SETTINGS})
+
+
+## DuplicateCheck with the current settings, using the store of unmanaged devices given
+def openCheck(expiry_store, sharded=False, locations=None):
+    keys, hostname_rules = duplicateSettings()
+
+    inventory_cache = None
+    if inventory_cache_file:
+        inventory_cache = InventoryCache(inventory_cache_file, full_resync_interval=full_resync_hours*60*60)
+
+    # Establish connection to XIQ, one extra connection is kept for the CCG lookup that runs during the collection
+    x = XIQ(token=token, pool_size=max(page_concurrency, shard_concurrency) + 1, url=xiq_url)
 
-    if status != "Success":
-        log_msg = f"Unmange API did not return a Success message!"
+    # sharded collection reads the locations from XIQ, the inventory cache only covers the whole org
+    location_ids = None
+    if sharded or locations:
+        location_ids = findShards(x, locations)
+        inventory_cache = None
+
+    return DuplicateCheck(x, expiry_store, ccg_group=ccg_group, inventory_cache=inventory_cache,
+                          page_concurrency=page_concurrency, batch_size=batch_size, batch_concurrency=batch_concurrency,
+                          location_ids=location_ids, partial=bool(locations), shard_concurrency=shard_concurrency,
+                          report_file=report_file, prometheus_file=prometheus_file, ccg_cache_file=ccg_cache_file,
+                          duplicate_keys=keys, hostname_rules=hostname_rules, journal_file=journal_file)
+
+
+## Called by the daemon on SIGHUP: re-read the settings and build a new DuplicateCheck from them.
+## The running check is kept when the settings can not be read or used
+def reloadCheck(check, sharded=False, locations=None):
+    current_settings = {name: globals()[name] for name in SETTINGS}
+    expiry_store = check.expiry_store
+    try:
+        reloadSettings()
+        if expiry_store_file != current_settings['expiry_store_file']:
+            expiry_store = openExpiryStore(expiry_store_file)
+        new_check = openCheck(expiry_store, sharded, locations)
+    except (Exception, SystemExit) as e:
+        # any mistake in the edited file ends up here, the daemon keeps running with what it had
+        # SystemExit comes from a check that printed the reason already
+        log_msg = f"Unable to reload the settings of {__file__}, the current settings are kept"
+        if str(e):
+            log_msg += f" - {e}"
         logger.error(log_msg)
         print(log_msg)
-        print("script is exiting...")
+        if expiry_store is not check.expiry_store:
+            expiry_store.close()
+        globals().update(current_settings)
+        return check, scan_interval_minutes*60
+    if expiry_store is not check.expiry_store:
+        check.expiry_store.close()
+    logger.info(f"Reloaded the settings of {__file__}")
+    return new_check, scan_interval_minutes*60
+
+
+def checkDuplicates(sharded=False, locations=None, daemon=False, snapshot_file=None, apply_file=None, event_port=None):
+    if not token:
+        print("Please add a token to the script.")
+        print("Script is exiting...")
         raise SystemExit
-    
-    # add devices to CCG group
-    if not ccg_found:
-        # create CCG with the devices
-        data = {
-          "name": ccg_group,
-          "description": "CCG for Unmanaged Duplicate APs",
-          "device_ids": device_ids
-        }
-        try:
-            ccg_id = x.createCCG(data)
-        except APICallFailedException as e:
-            print(f"API to create CCG {ccg_group} failed with {str(e)}.")
-            print("Script is exiting...")
-            raise SystemExit
-        if ccg_id:
-            log_msg = f"Successfully created CCG {ccg_id}"
-            logger.info(log_msg)
-            print(log_msg)
-            logger.info(f"Added devices {', '.join(map(str, device_ids))} to ccg {ccg_group}")
-    else:
-        # add devices to existing CCG
-        ccg_id = ccg_info['id']
-        ccg_devices = ccg_info['device_ids']
-        common_devices = set(ccg_devices) & set(device_ids)
-        if common_devices:
-            log_msg = (f"These devices are already in the {ccg_group} CCG: {', '.join(map(str, common_devices))}")
-            logger.info(log_msg)
-            print(log_msg)
-        device_ids = [device for device in device_ids if device not in ccg_devices]
-        ccg_devices.extend(device_ids)
+    duplicateSettings()
+    event_port = webhook_port if event_port is None else event_port
+    if daemon and event_port and not webhook_secret and webhook_host not in LOOPBACK_HOSTS:
+        print(f"Please set webhook_secret to listen for device events on {webhook_host}.")
+        print("Script is exiting...")
+        raise SystemExit
+    plan = None
+    if apply_file:
         try:
-            response = x.updateCCG(ccg_id, ccg_devices)   
-        except APICallFailedException as e:
-            print(f"API to update CCG {ccg_group} failed with {str(e)}.")
+            plan = loadPlan(apply_file)
+        except (OSError, ValueError) as e:
+            print(f"Unable to read plan {apply_file} - {e}")
             print("Script is exiting...")
             raise SystemExit
-        log_msg = f"Successfully updated CCG {ccg_group}"
-        logger.info(log_msg)
-        print(log_msg)
-        logger.info(f"Added devices {', '.join(map(str, device_ids))} to ccg {ccg_group}")
-
-    
-
-    new_devices = [{"device_id": device_id, "added_time":current_time, "expire_at": expire_time} for device_id in device_ids ]
-    json_file_change = True
-    
-else:
-    print("No Duplicates with one being managed and offline") 
-    #check if any ccg devices not in unmanaged_list
-    if ccg_found and ccg_info['device_ids']:
-        untracked_devices = [device_id for device_id in ccg_info['device_ids'] if not any(device_id == d['device_id'] for d in unmanaged_list)]
-        if untracked_devices:
-            log_msg = f"The following devices are in the CCG, but not in the unmanaged json file. No action will be preformed on these APs. {', '.join(map(str, untracked_devices))}"
-            logger.warning(log_msg)
-            print(log_msg)
-    # remove CCG if no devices
-    else:
-        # Delete ccg
-        if ccg_found:
+
+    # open the store of unmanaged devices
+    expiry_store = openExpiryStore(expiry_store_file)
+    if isinstance(expiry_store, SqliteExpiryStore):
+        expiry_store.importJson(unmanaged_file)
+
+    check = openCheck(expiry_store, sharded, locations)
+    try:
+        if plan is not None:
+            check.applyPlan(plan, loaded=True)
+        elif snapshot_file:
+            check.saveSnapshot(snapshot_file)
+        elif daemon:
+            receiver = None
+            if event_port:
+                receiver = DeviceEventReceiver(host=webhook_host, port=event_port, path=webhook_path, secret=webhook_secret)
+            service = DuplicateCheckService(check, scan_interval=scan_interval_minutes*60, receiver=receiver,
+                                            reload_callback=lambda check: reloadCheck(check, sharded, locations))
+            service.installSignalHandlers()
             try:
-                status = x.deleteCCG(ccg_info['id'])
-            except APICallFailedException as e:
-                logger.error(e)
-                print(e)
-                print("Script is exiting...")
-                raise SystemExit
-            logger.info(f"deleted CCG {ccg_info['name']} as no devices exist.")
-        logger.info(f"CCG {ccg_group} does not exist.")
-        
-# if changes to unamanged_list save the json file
-if json_file_change:
-    unmanaged_list.extend(new_devices)
-    with open(unmanaged_file, "w") as FH:
-        json.dump(unmanaged_list, FH)
+                service.run()
+            finally:
+                # a reload may have opened another store
+                expiry_store = service.check.expiry_store
+        else:
+            check.run()
+    except APICallFailedException:
+        print("Script is exiting...")
+        raise SystemExit
+    finally:
+        expiry_store.close()
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Unmanage and later delete offline APs that share a hostname with another AP in XIQ")
+    parser.add_argument('--tenants', metavar='CONFIG', help="JSON file of XIQ accounts to check, each with its own token")
+    parser.add_argument('--sharded', action='store_true', help=f"collect the devices of every {shard_type} location in parallel")
+    parser.add_argument('--locations', metavar='NAMES', help="comma separated location names or ids, only the devices in these locations are checked")
+    parser.add_argument('--daemon', action='store_true', help="keep running, scanning every scan_interval_minutes and deleting devices as they expire")
+    parser.add_argument('--webhook-port', type=int, metavar='PORT', help="with --daemon, listen for XIQ device events on this port instead of webhook_port")
+    parser.add_argument('--snapshot', metavar='FILE', help="collect the devices, the CCG and the tracked devices into a snapshot file without changing anything")
+    parser.add_argument('--plan', metavar='SNAPSHOT', help="work out the changes for a snapshot without calling XIQ, print them and save them to plan_file")
+    parser.add_argument('--apply', metavar='PLAN', help="make the changes of a saved plan")
+    args = parser.parse_args()
+    if args.tenants:
+        checkTenants(args.tenants)
+    elif args.plan:
+        planSnapshot(args.plan)
+    else:
+        checkDuplicates(sharded=args.sharded, locations=args.locations.split(',') if args.locations else None, daemon=args.daemon,
+                        snapshot_file=args.snapshot, apply_file=args.apply, event_port=args.webhook_port)
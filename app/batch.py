@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('Duplicate_Check.batch')
+
+
+# error passed to on_chunk for a chunk XIQ only acknowledged with a 202
+ACCEPTED = "accepted"
+
+
+# succeeded - ids of the chunks that completed, in the order they were given
+# accepted  - ids of the chunks XIQ acknowledged with a 202, they are not in succeeded until a read shows the change
+# failed    - id -> error message for the chunks that failed
+class BatchResult:
+    def __init__(self):
+        self.succeeded = []
+        self.accepted = []
+        self.failed = {}
+
+    def __bool__(self):
+        return not self.failed
+
+    def summary(self):
+        return f"{len(self.succeeded)} succeeded, {len(self.accepted)} accepted for async processing, {len(self.failed)} failed"
+
+
+def chunked(ids, chunk_size):
+    ids = list(ids)
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+# Splits an id list into chunks and submits them concurrently. A failed chunk is recorded and
+# does not stop the others, so the caller can act on exactly the ids that changed.
+class BatchExecutor:
+    def __init__(self, chunk_size=100, max_workers=4):
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+    ## call is run once per chunk and returns the HTTP status code, any exception fails the chunk.
+    ## on_chunk(chunk, error) is called from the worker as soon as a chunk is answered, error is None on success
+    ## and ACCEPTED for a 202
+    def run(self, call, ids, on_chunk=None):
+        result = BatchResult()
+        chunks = chunked(ids, self.chunk_size)
+        if not chunks:
+            return result
+        if on_chunk is not None:
+            call = self.__notify(call, on_chunk)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+            futures = [executor.submit(call, chunk) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    status = future.result()
+                except Exception as e:
+                    logger.error(f"batch of {len(chunk)} ids failed with {e}")
+                    for device_id in chunk:
+                        result.failed[device_id] = str(e)
+                    continue
+                if status == 202:
+                    result.accepted.extend(chunk)
+                else:
+                    result.succeeded.extend(chunk)
+        return result
+
+    @staticmethod
+    def __notify(call, on_chunk):
+        def notifyingCall(chunk):
+            try:
+                status = call(chunk)
+            except Exception as e:
+                on_chunk(chunk, str(e))
+                raise
+            on_chunk(chunk, ACCEPTED if status == 202 else None)
+            return status
+        return notifyingCall
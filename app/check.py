@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from app.xiq_api import APICallFailedException
+from app.duplicates import DuplicateIndex, checkDuplicateKeys, isUnmanageCandidate
+from app.plan import buildPlan, buildGroupPlan
+from app.snapshot import SnapshotWriter
+from app.batch import BatchResult
+from app.journal import RunJournal, MAX_RESUMES
+from app.storage import writeJsonAtomic
+from app.logger import summarizeIds, idFields, LOG_ID_SAMPLE
+
+logger = logging.getLogger('Duplicate_Check.check')
+
+
+# One duplicate AP check against one XIQ account.
+# Errors are logged and printed, then raised as APICallFailedException for the caller to stop on.
+class DuplicateCheck:
+    def __init__(self, x, expiry_store, ccg_group="MarkedAsReplaced", inventory_cache=None,
+                 page_concurrency=5, batch_size=100, batch_concurrency=4, expire_days=30,
+                 location_ids=None, partial=False, shard_concurrency=4, report_file=None, prometheus_file=None,
+                 ccg_cache_file=None, duplicate_keys=("hostname",), hostname_rules=None, journal_file=None):
+        self.x = x
+        self.expiry_store = expiry_store
+        self.ccg_group = ccg_group
+        self.inventory_cache = inventory_cache
+        self.page_concurrency = page_concurrency
+        self.batch_size = batch_size
+        self.batch_concurrency = batch_concurrency
+        self.expire_days = expire_days
+        # with location_ids the devices are collected per location in parallel, partial means
+        # the locations do not cover the whole org so devices not seen are not treated as gone
+        self.location_ids = location_ids
+        self.partial = partial
+        self.shard_concurrency = shard_concurrency
+        # the API and phase metrics of the XIQ client are written here after every run
+        self.report_file = report_file
+        self.prometheus_file = prometheus_file
+        # the resolved CCG id is kept here so later runs can revalidate it with one GET
+        self.ccg_cache_file = ccg_cache_file
+        self.ccg_id = self.__loadCCGId()
+        # device fields duplicates are matched on and how hostnames are compared, see app.duplicates
+        checkDuplicateKeys(duplicate_keys)
+        self.duplicate_keys = tuple(duplicate_keys)
+        self.hostname_rules = hostname_rules
+        # write-ahead journal of the changes of a run, see app.journal
+        self.journal_file = journal_file
+        # devices of the last full run, kept up to date by device events, see evaluateDevices
+        self.duplicate_index = None
+
+    def __fail(self, log_msg):
+        logger.error(log_msg)
+        print(log_msg)
+        raise APICallFailedException(log_msg)
+
+    def __loadCCGId(self):
+        if not self.ccg_cache_file or not os.path.exists(self.ccg_cache_file):
+            return None
+        try:
+            with open(self.ccg_cache_file) as FH:
+                return json.load(FH).get(self.ccg_group)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read {self.ccg_cache_file} - {e}")
+            return None
+
+    def __saveCCGId(self, ccg_id):
+        if ccg_id == self.ccg_id:
+            return
+        self.ccg_id = ccg_id
+        if self.ccg_cache_file:
+            writeJsonAtomic(self.ccg_cache_file, {self.ccg_group: ccg_id} if ccg_id is not None else {})
+
+    ## check if CCG group exists
+    def checkCCG(self):
+        try:
+            ccg_found, ccg_info = self.x.checkForCCG(ccg_name=self.ccg_group, ccg_id=self.ccg_id)
+        except APICallFailedException as e:
+            self.__fail(f"API to find CCG {self.ccg_group} failed with {str(e)}.")
+        self.__saveCCGId(ccg_info['id'] if ccg_found else None)
+        return ccg_found, ccg_info
+
+    ## With a snapshot every device is also written to it as it passes
+    def collectDuplicateIndex(self, snapshot=None):
+        # pages are added to the hostname index as they arrive
+        duplicate_index = DuplicateIndex(keys=self.duplicate_keys, hostname_rules=self.hostname_rules)
+        try:
+            if self.location_ids is not None:
+                devices = self.x.iterShardedDevices(self.location_ids, shard_concurrency=self.shard_concurrency)
+            elif self.inventory_cache is not None:
+                devices = self.x.collectDevices(concurrency=self.page_concurrency, cache=self.inventory_cache)
+            else:
+                devices = self.x.iterDevices(concurrency=self.page_concurrency)
+            duplicate_index.addDevices(snapshot.record(devices) if snapshot is not None else devices)
+        except APICallFailedException as e:
+            self.__fail(f"API to collect devices failed with {str(e)}.")
+        return duplicate_index
+
+    ## True when the collected devices are the whole org
+    def isComplete(self, duplicate_index):
+        if self.partial:
+            return False
+        if self.location_ids is None:
+            return True
+        try:
+            total_count = self.x.countDevices()
+        except APICallFailedException as e:
+            self.__fail(f"API to count devices failed with {str(e)}.")
+        if total_count > len(duplicate_index.device_ids):
+            log_msg = f"{total_count - len(duplicate_index.device_ids)} devices are not assigned to a collected location, devices that were not found will stay tracked"
+            logger.warning(log_msg)
+            print(log_msg)
+            return False
+        return True
+
+    ## Collect the devices, the CCG and the unmanaged devices, the last two run alongside the device collection.
+    ## The unmanaged devices are their ids and the ids that have expired by current_time
+    def collect(self, current_time, snapshot=None):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            ccg_future = executor.submit(self.checkCCG)
+            tracked_future = executor.submit(lambda: (self.expiry_store.trackedIds(), self.expiry_store.expired(current_time)))
+            duplicate_index = self.collectDuplicateIndex(snapshot)
+            ccg_found, ccg_info = ccg_future.result()
+            tracked_ids, expired_ids = tracked_future.result()
+        return duplicate_index, ccg_found, ccg_info, tracked_ids, expired_ids
+
+    ## Unmanage or delete devices in chunks. With a journal every chunk XIQ answers is recorded, and chunks that
+    ## succeeded before an interruption are taken from the journal instead of being sent again
+    def bulkAction(self, action, device_ids, journal=None):
+        bulk_call = self.x.bulkUnmanageDevices if action == "unmanage" else self.x.bulkDeleteDevices
+        if journal is None:
+            return bulk_call(device_ids, chunk_size=self.batch_size, max_workers=self.batch_concurrency)
+        result = BatchResult()
+        done = set()
+        for chunk, error in journal.chunks.get(action, []):
+            # a chunk XIQ refused changed nothing and one it only accepted may not have, both are sent again
+            if error is None:
+                result.succeeded.extend(chunk)
+                done.update(chunk)
+        remaining = [device_id for device_id in device_ids if device_id not in done]
+        if done:
+            logger.info(f"{len(done)} devices were already {action}d before the run was interrupted, {len(remaining)} are left")
+        if remaining:
+            sent = bulk_call(remaining, chunk_size=self.batch_size, max_workers=self.batch_concurrency,
+                             on_chunk=lambda chunk, error: journal.recordChunk(action, chunk, error))
+            result.succeeded.extend(sent.succeeded)
+            result.accepted.extend(sent.accepted)
+            result.failed.update(sent.failed)
+        return result
+
+    # Function to remove the expired devices
+    def removeExpiredDevices(self, expired_device_list, journal=None):
+        log_msg = f"The following devices will be deleted from XIQ as they have reached expiration date: {summarizeIds(expired_device_list)}"
+        logger.info(log_msg, extra=idFields(expired_device_list))
+        print(log_msg)
+        result = self.bulkAction("delete", expired_device_list, journal)
+        if result.accepted:
+            log_msg = f"XIQ accepted deleting {len(result.accepted)} devices but they were still found, they stay tracked until a later run: {summarizeIds(result.accepted)}"
+            logger.warning(log_msg, extra=idFields(result.accepted))
+            print(log_msg)
+        if result.failed:
+            log_msg = f"Failed to delete {len(result.failed)} devices, they will be retried on the next run: {summarizeIds(result.failed)}"
+            logger.error(log_msg, extra=idFields(result.failed))
+            print(log_msg)
+        return result.succeeded
+
+    def deleteCCG(self, ccg_info):
+        try:
+            self.x.deleteCCG(ccg_info['id'])
+        except APICallFailedException as e:
+            self.__fail(str(e))
+        self.__saveCCGId(None)
+        log_msg = (f"deleted CCG {ccg_info['name']} as no devices exist.")
+        logger.info(log_msg)
+        print(log_msg)
+
+    ## Run the check, returns a summary of what was done. An interrupted earlier run is finished instead
+    def run(self):
+        try:
+            summary = self.resume()
+            if summary is None:
+                summary = self.__run()
+            return summary
+        finally:
+            self.writeReport()
+
+    ## Finish a run that was interrupted from its journal, without collecting the devices again.
+    ## Returns None when there is nothing to resume
+    def resume(self):
+        if not self.journal_file:
+            return None
+        journal = RunJournal(self.journal_file)
+        if not journal.exists():
+            return None
+        try:
+            usable = journal.load()
+        except OSError as e:
+            logger.warning(f"Unable to read journal {self.journal_file} - {e}")
+            usable = False
+        if not usable or journal.resumes >= MAX_RESUMES:
+            log_msg = f"The interrupted run in {self.journal_file} can not be finished, it is set aside and a new run is started"
+            logger.warning(log_msg)
+            print(log_msg)
+            journal.discard()
+            return None
+        log_msg = f"Finishing the run interrupted at {time.ctime(journal.current_time)}"
+        logger.info(log_msg)
+        print(log_msg)
+        with self.x.metrics.phase("mutate"):
+            summary = self.applyPlan(journal.plan, journal.current_time, journal)
+        summary["resumed"] = True
+        return summary
+
+    def writeReport(self):
+        if self.report_file or self.prometheus_file:
+            self.x.metrics.writeReport(self.report_file, self.prometheus_file, extra={"controller": self.x.controller.report()})
+
+    def __run(self):
+        #collect time info
+        current_time = time.mktime(datetime.now().timetuple())
+
+        metrics = self.x.metrics
+        with metrics.phase("collect"):
+            duplicate_index, ccg_found, ccg_info, tracked_ids, expired_ids = self.collect(current_time)
+            complete = self.isComplete(duplicate_index)
+
+        with metrics.phase("detect"):
+            # the duplicate groups are worked out here and kept in the index for the plan
+            duplicate_index.mergedGroups()
+
+        with metrics.phase("reconcile"):
+            # check for devices that time has run out or no longer exist in XIQ
+            plan = buildPlan(duplicate_index, ccg_found, ccg_info, tracked_ids, expired_ids, self.ccg_group, current_time, complete)
+
+        with metrics.phase("mutate"):
+            summary = self.applyPlan(plan, current_time)
+        duplicate_index.removeDevices(summary['deleted'])
+        duplicate_index.setAdminState(summary['unmanaged'], "UNMANAGED")
+        self.duplicate_index = duplicate_index
+        return summary
+
+    ## Check only the duplicate groups of devices that changed since the last full run, as reported by device events.
+    ## The devices are already updated in duplicate_index, nothing is collected. Returns the summary, or None when
+    ## no device needs to be unmanaged
+    def evaluateDevices(self, device_ids):
+        duplicate_index = self.duplicate_index
+        groups = duplicate_index.groupsFor(device_ids)
+        tracked_ids = self.expiry_store.trackedIds()
+        if not any(isUnmanageCandidate(device) and device['id'] not in tracked_ids for group in groups for device in group.devices):
+            return None
+        current_time = time.mktime(datetime.now().timetuple())
+        try:
+            with self.x.metrics.phase("events"):
+                # events are not trusted to unmanage anything, the devices of the groups are read again from XIQ
+                # and the groups worked out from what XIQ returns. A device that can not be read is left alone
+                unverified = set()
+                for group in groups:
+                    for device in group.devices:
+                        try:
+                            duplicate_index.addDevice(self.x.getDevice(device['id']))
+                        except APICallFailedException as e:
+                            logger.warning(f"API to read device {device['id']} failed with {e}, it is not unmanaged")
+                            unverified.add(device['id'])
+                groups = duplicate_index.groupsFor(device_ids)
+                skipped = tracked_ids | unverified
+                if not any(isUnmanageCandidate(device) and device['id'] not in skipped for group in groups for device in group.devices):
+                    logger.info(f"The devices of {len(device_ids)} device events are not offline duplicates in XIQ")
+                    return None
+                tracked_ids = skipped
+                ccg_found, ccg_info = self.checkCCG()
+                plan = buildGroupPlan(groups, ccg_found, ccg_info, tracked_ids, self.ccg_group, current_time,
+                                      len(duplicate_index.device_ids))
+                summary = self.applyPlan(plan, current_time)
+        finally:
+            self.writeReport()
+        duplicate_index.setAdminState(summary['unmanaged'], "UNMANAGED")
+        return summary
+
+    ## Collect the devices, the CCG and the tracked devices into a snapshot file, nothing is changed in XIQ
+    def saveSnapshot(self, snapshot_file):
+        snapshot = SnapshotWriter(snapshot_file)
+        try:
+            with self.x.metrics.phase("collect"):
+                duplicate_index, ccg_found, ccg_info, tracked_ids, expired_ids = self.collect(snapshot.created, snapshot)
+                complete = self.isComplete(duplicate_index)
+                # the snapshot keeps every tracked entry, so it can be planned as of a later time
+                unmanaged_list = self.expiry_store.entries()
+        except BaseException:
+            snapshot.abort()
+            raise
+        finally:
+            self.writeReport()
+        snapshot.close(self.ccg_group, ccg_info if ccg_found else None, unmanaged_list, complete)
+        log_msg = f"Saved {snapshot.count} devices to {snapshot_file}"
+        logger.info(log_msg)
+        print(log_msg)
+
+    ## Run a step once, a step the journal has as done returns its recorded result instead
+    def __step(self, journal, step, action):
+        if journal is None:
+            return action()
+        if journal.isDone(step):
+            return journal.steps[step]
+        result = action()
+        journal.recordStep(step, result)
+        return result
+
+    ## Delete the expired devices, unmanage the new duplicates and update the CCG and the store as the plan says.
+    ## Devices that fail are left out of the later steps, the summary says what was actually done.
+    ## With journal_file set the plan and every finished step are journaled, so an interrupted run can be resumed.
+    ## loaded is for a plan read from a file, the CCG may have changed since it was made so it is read again
+    def applyPlan(self, plan, current_time=None, journal=None, loaded=False):
+        if current_time is None:
+            current_time = time.mktime(datetime.now().timetuple())
+        if journal is None and self.journal_file:
+            journal = RunJournal(self.journal_file)
+            if journal.exists():
+                self.__fail(f"An interrupted run in {self.journal_file} has to be finished first, run the check without a plan to finish it")
+            journal.begin(plan, current_time)
+        try:
+            summary = self.__apply(plan, current_time, journal, loaded)
+        finally:
+            if journal is not None:
+                journal.close()
+        if journal is not None:
+            journal.finish()
+        return summary
+
+    ## The CCG as it is now. XIQ only replaces the whole member list, so the CCG is read again before it is changed
+    ## when the plan's copy may be out of date: a plan loaded from a file, or a resumed run that has not recorded
+    ## its CCG change, as the call may have gone through
+    def __liveCCG(self, journal, ccg_found, ccg_info, deleted_set, loaded):
+        if journal is not None and journal.isDone("ccg"):
+            return ccg_found, ccg_info
+        if not loaded and (journal is None or not journal.resumed):
+            return ccg_found, ccg_info
+        ccg_found, live_info = self.checkCCG()
+        if not ccg_found:
+            return False, {"id": None, "name": self.ccg_group, "device_ids": []}
+        return True, {"id": live_info['id'], "name": live_info['name'],
+                      "device_ids": [device_id for device_id in live_info.get('device_ids', []) if device_id not in deleted_set]}
+
+    def __apply(self, plan, current_time, journal, loaded=False):
+        expire_time = current_time + self.expire_days*24*60*60
+        summary = {"devices": plan['devices'], "duplicate_hostnames": plan['duplicate_hostnames'], "unmanaged": [], "deleted": [],
+                   "vanished": [], "failed": [], "ccg": "unchanged"}
+        ccg_found = plan['ccg']['found']
+        ccg_info = {"id": plan['ccg']['id'], "name": plan['ccg']['name'], "device_ids": plan['ccg']['device_ids']}
+
+        deleted_devices = []
+        deleted_set = set()
+        if plan['delete']:
+            deleted_devices = self.removeExpiredDevices(plan['delete'], journal)
+            deleted_set = set(deleted_devices)
+            ccg_info['device_ids'] = [device_id for device_id in ccg_info['device_ids'] if device_id not in deleted_set]
+            summary["failed"].extend(device_id for device_id in plan['delete'] if device_id not in deleted_set)
+        vanished = plan['untrack']
+        summary["deleted"] = deleted_devices
+        summary["vanished"] = vanished
+
+        # stop tracking the deleted and vanished devices
+        if deleted_devices or vanished:
+            self.__step(journal, "untrack", lambda: self.expiry_store.remove(deleted_devices + vanished))
+
+        def deleteCCG():
+            self.deleteCCG(ccg_info)
+            return "deleted"
+
+        if not plan['has_duplicates']:
+            print("No Duplicate APs name found")
+            if ccg_found and not ccg_info['device_ids']:
+                ccg_found, ccg_info = self.__liveCCG(journal, ccg_found, ccg_info, deleted_set, loaded)
+                if ccg_found and not ccg_info['device_ids']:
+                    summary["ccg"] = self.__step(journal, "ccg", deleteCCG)
+            return summary
+
+        new_devices = []
+        device_ids = plan['unmanage']
+
+        if device_ids:
+            # the groups are logged as a count and a sample, the full list is in the plan
+            groups = plan['candidates']
+            logger.info(f"{len(groups)} duplicate groups have offline devices to unmanage: {', '.join(group['name'] for group in groups[:LOG_ID_SAMPLE])}"
+                        + (f" and {len(groups) - LOG_ID_SAMPLE} more" if len(groups) > LOG_ID_SAMPLE else ""),
+                        extra={"group_count": len(groups), "group_sample": groups[:LOG_ID_SAMPLE]})
+            # Unmanage offline duplicate devices
+            result = self.bulkAction("unmanage", device_ids, journal)
+            if result.failed:
+                log_msg = f"Failed to unmanage {len(result.failed)} devices, they will be retried on the next run: {summarizeIds(result.failed)}"
+                logger.error(log_msg, extra=idFields(result.failed))
+                print(log_msg)
+                summary["failed"].extend(result.failed)
+            if result.accepted:
+                # not tracked or added to the CCG, a later run unmanages them again if they are still managed
+                log_msg = f"XIQ accepted unmanaging {len(result.accepted)} devices but they were still managed, they are not tracked: {summarizeIds(result.accepted)}"
+                logger.warning(log_msg, extra=idFields(result.accepted))
+                print(log_msg)
+                summary["failed"].extend(result.accepted)
+            if not result.succeeded:
+                self.__fail(f"Unmange API did not return a Success message!")
+            # only the devices that were unmanaged are added to the CCG and tracked
+            unmanaged_set = set(result.succeeded)
+            device_ids = result.succeeded
+
+            # add devices to CCG group
+            ccg_was_found = ccg_found
+            ccg_found, ccg_info = self.__liveCCG(journal, ccg_found, ccg_info, deleted_set, loaded)
+            if not ccg_found:
+                # create CCG with the devices
+                def createCCG():
+                    data = {
+                      "name": self.ccg_group,
+                      "description": "CCG for Unmanaged Duplicate APs",
+                      "device_ids": device_ids
+                    }
+                    try:
+                        ccg_id = self.x.createCCG(data)
+                    except APICallFailedException as e:
+                        self.__fail(f"API to create CCG {self.ccg_group} failed with {str(e)}.")
+                    if not ccg_id:
+                        return "unchanged"
+                    self.__saveCCGId(ccg_id)
+                    log_msg = f"Successfully created CCG {ccg_id}"
+                    logger.info(log_msg)
+                    print(log_msg)
+                    logger.info(f"Added devices {summarizeIds(device_ids)} to ccg {self.ccg_group}", extra=idFields(device_ids))
+                    return "created"
+                summary["ccg"] = self.__step(journal, "ccg", createCCG)
+            else:
+                # add devices to existing CCG
+                ccg_id = ccg_info['id']
+                if plan['ccg']['in_ccg']:
+                    log_msg = (f"These devices are already in the {self.ccg_group} CCG: {summarizeIds(plan['ccg']['in_ccg'])}")
+                    logger.info(log_msg)
+                    print(log_msg)
+                # a CCG created by the interrupted run is not in the plan, so every unmanaged device is checked against it
+                ccg_add = plan['ccg']['add'] if ccg_was_found else device_ids
+                device_ids = [device_id for device_id in ccg_add if device_id in unmanaged_set]
+
+                def updateCCG():
+                    try:
+                        ccg_devices = self.x.updateCCGMembership(ccg_id, ccg_info['device_ids'], add=device_ids)
+                    except APICallFailedException as e:
+                        self.__fail(f"API to update CCG {self.ccg_group} failed with {str(e)}.")
+                    if ccg_devices is None:
+                        return "unchanged"
+                    ccg_info['device_ids'] = ccg_devices
+                    log_msg = f"Successfully updated CCG {self.ccg_group}"
+                    logger.info(log_msg)
+                    print(log_msg)
+                    logger.info(f"Added devices {summarizeIds(device_ids)} to ccg {self.ccg_group}", extra=idFields(device_ids))
+                    return "updated"
+                summary["ccg"] = self.__step(journal, "ccg", updateCCG)
+
+            new_devices = [{"device_id": device_id, "added_time":current_time, "expire_at": expire_time} for device_id in device_ids ]
+            summary["unmanaged"] = device_ids
+
+        else:
+            print("No Duplicates with one being managed and offline")
+            #check if any ccg devices not in unmanaged_list
+            if ccg_found and ccg_info['device_ids']:
+                untracked_devices = plan['ccg']['untracked']
+                if untracked_devices:
+                    log_msg = f"The following devices are in the CCG, but not in the unmanaged device store. No action will be preformed on these APs. {summarizeIds(untracked_devices)}"
+                    logger.warning(log_msg)
+                    print(log_msg)
+            # remove CCG if no devices
+            else:
+                # Delete ccg
+                if ccg_found:
+                    ccg_found, ccg_info = self.__liveCCG(journal, ccg_found, ccg_info, deleted_set, loaded)
+                    if ccg_found and not ccg_info['device_ids']:
+                        summary["ccg"] = self.__step(journal, "ccg", deleteCCG)
+                logger.info(f"CCG {self.ccg_group} does not exist.")
+
+        # track the newly unmanaged devices
+        if new_devices:
+            self.__step(journal, "track", lambda: self.expiry_store.add(new_devices))
+        return summary
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+import logging
+import re
+from array import array
+from collections import namedtuple
+from app.inventory import CompactInventory
+
+logger = logging.getLogger('Duplicate_Check.duplicates')
+
+# device fields duplicates can be matched on
+DUPLICATE_KEYS = ("hostname", "serial_number", "mac_address")
+
+# name    - hostname of the first device of the group
+# devices - every device of the group
+# reasons - "key value" for every shared value that put devices in the group, e.g. "serial_number SN1234"
+DuplicateGroup = namedtuple('DuplicateGroup', ['name', 'devices', 'reasons'])
+
+
+def isUnmanageCandidate(device):
+    # a duplicate is only unmanaged when it is still managed but not connected
+    return device.get('connected') is False and device.get('device_admin_state') == 'MANAGED'
+
+
+# Hostname matching rules. The strip patterns are regular expressions removed from the hostname,
+# e.g. r"[-_.]old$" makes "AP-01-old" match "AP-01"
+class HostnameRules:
+    def __init__(self, ignore_case=True, strip_patterns=()):
+        self.ignore_case = ignore_case
+        try:
+            self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in strip_patterns]
+        except re.error as e:
+            raise ValueError(f"invalid hostname strip pattern - {e}")
+
+    def normalize(self, hostname):
+        hostname = hostname.strip()
+        for pattern in self.patterns:
+            hostname = pattern.sub("", hostname)
+        if self.ignore_case:
+            hostname = hostname.casefold()
+        return hostname or None
+
+
+## HostnameRules for the settings, None when hostnames are compared as they are
+def hostnameRules(ignore_case=False, strip_patterns=()):
+    if not ignore_case and not strip_patterns:
+        return None
+    return HostnameRules(ignore_case, strip_patterns)
+
+
+def checkDuplicateKeys(keys):
+    unknown = [key for key in keys if key not in DUPLICATE_KEYS]
+    if unknown or not keys:
+        raise ValueError(f"duplicate keys must be some of {', '.join(DUPLICATE_KEYS)}, got {', '.join(map(str, keys))}")
+
+
+# separators written between the octets of a MAC address
+MAC_SEPARATORS = str.maketrans("", "", ":-. ")
+
+
+def normalizeMac(mac_address):
+    return mac_address.translate(MAC_SEPARATORS).upper() or None
+
+
+def normalizeSerial(serial_number):
+    return serial_number.strip().upper() or None
+
+
+# Rows of one key chained by value. Only the values held by more than one row are kept in shared,
+# so finding the duplicates does not have to look at every value
+class KeyIndex:
+    def __init__(self, key, normalize):
+        self.key = key
+        self.normalize = normalize
+        # value -> newest row with it, row -> the row before it with the same value
+        self.heads = {}
+        self.next = array('l')
+        self.values = []
+        # value -> number of rows, for values with more than one row
+        self.shared = {}
+
+    def value(self, device):
+        value = device.get(self.key)
+        if not value:
+            return None
+        if self.normalize is not None:
+            return self.normalize(value)
+        return value
+
+    def __link(self, row, value):
+        self.values[row] = value
+        if value is None:
+            self.next[row] = -1
+            return
+        head = self.heads.get(value, -1)
+        self.next[row] = head
+        self.heads[value] = row
+        if head >= 0:
+            self.shared[value] = self.shared.get(value, 1) + 1
+
+    def __unlink(self, row):
+        value = self.values[row]
+        if value is None:
+            return
+        previous = -1
+        current = self.heads[value]
+        while current != row:
+            previous = current
+            current = self.next[current]
+        if previous >= 0:
+            self.next[previous] = self.next[row]
+        elif self.next[row] >= 0:
+            self.heads[value] = self.next[row]
+        else:
+            del self.heads[value]
+        count = self.shared.get(value)
+        if count is not None:
+            if count > 2:
+                self.shared[value] = count - 1
+            else:
+                del self.shared[value]
+
+    def add(self, row, device):
+        self.next.append(-1)
+        self.values.append(None)
+        self.__link(row, self.value(device))
+
+    def update(self, row, device):
+        value = self.value(device)
+        if value != self.values[row]:
+            self.__unlink(row)
+            self.__link(row, value)
+
+    ## Rows with the value, in the order they were added
+    def rows(self, value):
+        rows = []
+        row = self.heads.get(value, -1)
+        while row >= 0:
+            rows.append(row)
+            row = self.next[row]
+        rows.reverse()
+        return rows
+
+
+# Devices are held in a CompactInventory and indexed by every key in the same pass as they are added page by page.
+# Devices sharing a value of any key are merged into one group when the groups are asked for.
+class DuplicateIndex:
+    def __init__(self, devices=None, keys=("hostname",), hostname_rules=None):
+        checkDuplicateKeys(keys)
+        normalizers = {
+            "hostname": hostname_rules.normalize if hostname_rules is not None else None,
+            "serial_number": normalizeSerial,
+            "mac_address": normalizeMac
+        }
+        self.keys = tuple(keys)
+        self.inventory = CompactInventory(extra_fields=[key for key in self.keys if key != "hostname"])
+        # exact hostnames are grouped by the hostname chains of the inventory, every other key has its own index
+        self.sources = [(key, None if key == "hostname" and hostname_rules is None else KeyIndex(key, normalizers[key]))
+                        for key in self.keys]
+        self.indexes = [index for key, index in self.sources if index is not None]
+        self.merged = None
+        if devices is not None:
+            self.addDevices(devices)
+
+    ## ids of every device seen, including the ones without any key value
+    @property
+    def device_ids(self):
+        return self.inventory
+
+    def addDevice(self, device):
+        self.merged = None
+        known = len(self.inventory.ids)
+        row = self.inventory.add(device)
+        if row == known:
+            for index in self.indexes:
+                index.add(row, device)
+        else:
+            for index in self.indexes:
+                index.update(row, device)
+
+    def addDevices(self, devices):
+        for device in devices:
+            self.addDevice(device)
+
+    ## Drop devices that are gone from XIQ, e.g. the ones the check deleted
+    def removeDevices(self, device_ids):
+        for device_id in device_ids:
+            row = self.inventory.rows.get(device_id)
+            if row is None:
+                continue
+            self.merged = None
+            for index in self.indexes:
+                index.update(row, {})
+            self.inventory.remove(device_id)
+
+    ## Groups of devices that share a value of any key, merged across keys
+    def mergedGroups(self):
+        if self.merged is None:
+            self.merged = self.__merge()
+        return self.merged
+
+    def __sharedRows(self):
+        inventory = self.inventory
+        for key, index in self.sources:
+            if index is None:
+                for code in inventory.sharedHostnameCodes():
+                    yield f"{key} {inventory.hostnames[code]}", inventory.hostnameRows(code)
+            else:
+                for value in index.shared:
+                    yield f"{key} {value}", index.rows(value)
+
+    def __merge(self):
+        # union-find over the rows of every value that has more than one row
+        parent = {}
+
+        def find(row):
+            root = row
+            while parent[root] != root:
+                root = parent[root]
+            while parent[row] != root:
+                parent[row], row = root, parent[row]
+            return root
+
+        links = []
+        for reason, rows in self.__sharedRows():
+            first = None
+            for row in rows:
+                if row not in parent:
+                    parent[row] = row
+                if first is None:
+                    first = find(row)
+                else:
+                    root = find(row)
+                    if root != first:
+                        parent[root] = first
+            links.append((rows[0], reason))
+
+        members = {}
+        for row in parent:
+            members.setdefault(find(row), []).append(row)
+        reasons = {}
+        for row, reason in links:
+            reasons.setdefault(find(row), []).append(reason)
+        groups = []
+        for root, rows in members.items():
+            devices = [self.inventory.device(row) for row in rows]
+            name = next((device['hostname'] for device in devices if device.get('hostname')), str(devices[0]['id']))
+            groups.append(DuplicateGroup(name, devices, reasons[root]))
+        return groups
+
+    ## Key values of a row with the rows that share each one
+    def __rowValues(self, row):
+        inventory = self.inventory
+        for key, index in self.sources:
+            if index is None:
+                code = inventory.hostname_codes[row]
+                if code >= 0:
+                    yield (key, code), f"{key} {inventory.hostnames[code]}", inventory.hostnameRows(code)
+            else:
+                value = index.values[row]
+                if value is not None:
+                    yield (key, value), f"{key} {value}", index.rows(value)
+
+    ## The duplicate groups of some devices, worked out from their own key values instead of the whole index
+    def groupsFor(self, device_ids):
+        seen = set()
+        groups = []
+        for device_id in device_ids:
+            row = self.inventory.rows.get(device_id)
+            if row is None or row in seen:
+                continue
+            seen.add(row)
+            component = []
+            reasons = []
+            values_seen = set()
+            pending = [row]
+            while pending:
+                current = pending.pop()
+                component.append(current)
+                for value, reason, rows in self.__rowValues(current):
+                    if value in values_seen or len(rows) < 2:
+                        continue
+                    values_seen.add(value)
+                    reasons.append(reason)
+                    for other in rows:
+                        if other not in seen:
+                            seen.add(other)
+                            pending.append(other)
+            if len(component) > 1:
+                devices = [self.inventory.device(member) for member in sorted(component)]
+                name = next((device['hostname'] for device in devices if device.get('hostname')), str(devices[0]['id']))
+                groups.append(DuplicateGroup(name, devices, reasons))
+        return groups
+
+    ## Record an admin state change made by the check, e.g. the devices it unmanaged
+    def setAdminState(self, device_ids, admin_state):
+        for device_id in device_ids:
+            device = self.inventory.byId(device_id)
+            if device is not None:
+                device['device_admin_state'] = admin_state
+                self.addDevice(device)
+
+    def duplicateGroups(self):
+        for group in self.mergedGroups():
+            yield group.name, group.devices
+
+    def hasDuplicates(self):
+        return bool(self.mergedGroups())
+
+    ## managed but disconnected devices for every duplicate group
+    def unmanageCandidates(self):
+        for group in self.mergedGroups():
+            candidates = [int(device['id']) for device in group.devices if isUnmanageCandidate(device)]
+            if candidates:
+                yield group, candidates
+
+    def candidateIds(self):
+        return [device_id for group, candidates in self.unmanageCandidates() for device_id in candidates]
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import logging
+import json
+import hmac
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger('Duplicate_Check.events')
+
+# device event types handled, anything else is acknowledged and ignored
+DEVICE_CONNECTED = "DEVICE_CONNECTED"
+DEVICE_DISCONNECTED = "DEVICE_DISCONNECTED"
+DEVICE_ONBOARDED = "DEVICE_ONBOARDED"
+DEVICE_HOSTNAME_CHANGED = "DEVICE_HOSTNAME_CHANGED"
+EVENT_TYPES = (DEVICE_CONNECTED, DEVICE_DISCONNECTED, DEVICE_ONBOARDED, DEVICE_HOSTNAME_CHANGED)
+
+# addresses the receiver may listen on without a secret
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+# largest request body the receiver reads
+MAX_BODY_SIZE = 10*1024*1024
+
+# device fields an event may carry, either at the top of the event or under "data" or "device". The admin state
+# is not taken from events, and devices are read again from XIQ before anything is unmanaged
+EVENT_DEVICE_FIELDS = ("hostname", "serial_number", "mac_address", "connected")
+
+
+## One event of a webhook delivery as {"type", "device_id", "device"}, None when it is not a device event this check uses.
+## device holds only the fields the event carried
+def parseEvent(event):
+    if not isinstance(event, dict):
+        return None
+    event_type = str(event.get('event_type') or event.get('type') or '').upper()
+    if event_type not in EVENT_TYPES:
+        return None
+    data = dict(event)
+    for nested in ('data', 'device'):
+        if isinstance(event.get(nested), dict):
+            data.update(event[nested])
+    device_id = data.get('device_id', data.get('id'))
+    try:
+        device_id = int(device_id)
+    except (TypeError, ValueError):
+        return None
+    device = {field: data[field] for field in EVENT_DEVICE_FIELDS if field in data}
+    if 'new_hostname' in data:
+        device['hostname'] = data['new_hostname']
+    if event_type == DEVICE_CONNECTED:
+        device['connected'] = True
+    elif event_type == DEVICE_DISCONNECTED:
+        device['connected'] = False
+    return {"type": event_type, "device_id": device_id, "device": device}
+
+
+## The device events of one webhook delivery, which holds a single event, a list of them or {"events": [...]}
+def parseEvents(payload):
+    if isinstance(payload, dict) and isinstance(payload.get('events'), list):
+        payload = payload['events']
+    if not isinstance(payload, list):
+        payload = [payload]
+    events = []
+    for event in payload:
+        parsed = parseEvent(event)
+        if parsed is None:
+            logger.debug(f"Ignored event {event}")
+        else:
+            events.append(parsed)
+    return events
+
+
+## Apply one event to the duplicate index and return the id of the device it changed, None when it changed nothing.
+## A device the index does not hold yet is read with fetch_device when the event does not carry its hostname
+def applyDeviceEvent(duplicate_index, event, fetch_device=None):
+    device_id = event['device_id']
+    device = duplicate_index.inventory.byId(device_id)
+    if device is None:
+        device = {"id": device_id, "connected": None, "device_admin_state": "MANAGED"}
+        if 'hostname' not in event['device'] and fetch_device is not None:
+            fetched = fetch_device(device_id)
+            if fetched is None:
+                logger.warning(f"Device {device_id} of a {event['type']} event was not found in XIQ")
+                return None
+            device.update(fetched)
+    changed = dict(device, **event['device'])
+    if changed == device and device_id in duplicate_index.inventory:
+        return None
+    if event['type'] == DEVICE_ONBOARDED and device_id not in duplicate_index.inventory and not changed.get('connected'):
+        # a device that was just onboarded has not had the chance to connect, it is not an offline duplicate
+        changed['connected'] = None
+    duplicate_index.addDevice(changed)
+    return device_id
+
+
+# HTTP receiver for XIQ device event webhooks. Every POST to path is parsed and its device events
+# are handed to on_events from the request thread, which should only queue them. DuplicateCheckService
+# sets on_events to its own queue. With a secret the request needs "Authorization: Bearer <secret>",
+# and a secret is required to listen on anything but the loopback address.
+class DeviceEventReceiver:
+    def __init__(self, host="127.0.0.1", port=8443, path="/xiq/events", secret=None, on_events=None):
+        self.on_events = on_events
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.server = None
+        self.received = 0
+
+    def isAuthorized(self, header):
+        if not self.secret:
+            return True
+        return hmac.compare_digest((header or '').encode(), f"Bearer {self.secret}".encode())
+
+    def start(self):
+        if not self.secret and self.host not in LOOPBACK_HOSTS:
+            raise ValueError(f"a webhook secret is needed to listen for device events on {self.host}")
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+            def reply(self, status, data):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self.reply(200, {"status": "ok", "received": receiver.received})
+                else:
+                    self.reply(404, {"error_message": "not found"})
+
+            def do_POST(self):
+                if self.path.split('?')[0] != receiver.path:
+                    self.reply(404, {"error_message": "not found"})
+                    return
+                if not receiver.isAuthorized(self.headers.get('Authorization')):
+                    logger.warning(f"Refused device events from {self.address_string()}, wrong or missing secret")
+                    self.reply(401, {"error_message": "unauthorized"})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.reply(400, {"error_message": "Content-Length is not a non-negative integer"})
+                    self.close_connection = True
+                    return
+                if length > MAX_BODY_SIZE:
+                    self.reply(413, {"error_message": "payload too large"})
+                    self.close_connection = True
+                    return
+                try:
+                    payload = json.loads(self.rfile.read(length)) if length else None
+                except ValueError:
+                    self.reply(400, {"error_message": "body is not JSON"})
+                    return
+                events = parseEvents(payload)
+                receiver.received += len(events)
+                if events:
+                    receiver.on_events(events)
+                self.reply(202, {"accepted": len(events)})
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        log_msg = f"Listening for XIQ device events on {self.host}:{self.port}{self.path}"
+        logger.info(log_msg)
+        print(log_msg)
+        return self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from app.storage import writeJsonAtomic
+
+logger = logging.getLogger('Duplicate_Check.expiry_store')
+
+
+def readJsonList(path):
+    # an empty file is treated as an empty list
+    with open(path) as FH:
+        content = FH.read()
+    return json.loads(content) if content.strip() else []
+
+
+# Tracked unmanaged devices and the time they expire at.
+# Every entry is a dict of device_id, added_time and expire_at, the same records monitor_unmanaged.json holds.
+# A run only asks for the tracked ids and the expired ones, entries is for snapshots and the JSON store.
+class ExpiryStore(ABC):
+    @abstractmethod
+    def entries(self):
+        pass
+
+    def trackedIds(self):
+        return {device['device_id'] for device in self.entries()}
+
+    def expired(self, now):
+        return [device['device_id'] for device in self.entries() if device['expire_at'] <= now]
+
+    ## Earliest expire_at of the tracked devices after the time given, None when nothing is tracked
+    def nextExpiry(self, after=None):
+        return min((device['expire_at'] for device in self.entries() if after is None or device['expire_at'] > after), default=None)
+
+    def add(self, entries):
+        self.update(add=entries)
+
+    def remove(self, device_ids):
+        self.update(remove=device_ids)
+
+    @abstractmethod
+    def update(self, remove=(), add=()):
+        pass
+
+    def close(self):
+        pass
+
+
+# the original JSON list, now rewritten atomically
+class JsonExpiryStore(ExpiryStore):
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            self.__entries = readJsonList(path)
+        else:
+            print(f"{path} file not found")
+            self.__entries = []
+
+    def entries(self):
+        return list(self.__entries)
+
+    def update(self, remove=(), add=()):
+        remove = set(remove)
+        entries = [device for device in self.__entries if device['device_id'] not in remove]
+        added = {device['device_id'] for device in add}
+        entries = [device for device in entries if device['device_id'] not in added]
+        entries.extend(add)
+        writeJsonAtomic(self.path, entries)
+        self.__entries = entries
+
+
+# SQLite table indexed on device_id and expire_at, every update is one transaction
+class SqliteExpiryStore(ExpiryStore):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS unmanaged_devices ("
+                              "device_id INTEGER PRIMARY KEY, added_time REAL NOT NULL, expire_at REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS unmanaged_devices_expire_at ON unmanaged_devices (expire_at)")
+            # JSON files already imported, so they are left where they are and not imported twice
+            self.conn.execute("CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, imported_at REAL NOT NULL)")
+
+    def entries(self):
+        return [dict(row) for row in self.conn.execute("SELECT device_id, added_time, expire_at FROM unmanaged_devices")]
+
+    def trackedIds(self):
+        return {row[0] for row in self.conn.execute("SELECT device_id FROM unmanaged_devices")}
+
+    def expired(self, now):
+        return [row[0] for row in self.conn.execute(
+            "SELECT device_id FROM unmanaged_devices WHERE expire_at <= ? ORDER BY expire_at", (now,))]
+
+    def nextExpiry(self, after=None):
+        if after is None:
+            return self.conn.execute("SELECT MIN(expire_at) FROM unmanaged_devices").fetchone()[0]
+        return self.conn.execute("SELECT MIN(expire_at) FROM unmanaged_devices WHERE expire_at > ?", (after,)).fetchone()[0]
+
+    def update(self, remove=(), add=()):
+        with self.conn:
+            self.__write(remove, add)
+
+    ## The statements of an update, run inside the caller's transaction
+    def __write(self, remove=(), add=()):
+        self.conn.executemany("DELETE FROM unmanaged_devices WHERE device_id = ?", ((device_id,) for device_id in remove))
+        self.conn.executemany("INSERT OR REPLACE INTO unmanaged_devices (device_id, added_time, expire_at) VALUES (?, ?, ?)",
+                              ((device['device_id'], device['added_time'], device['expire_at']) for device in add))
+
+    ## One time import of a monitor_unmanaged.json file. The file is recorded as imported in the same transaction
+    ## and left in place, so a later run does not import it again
+    def importJson(self, json_path):
+        if not os.path.exists(json_path):
+            return 0
+        path = os.path.abspath(json_path)
+        # earlier versions renamed the file to .imported instead
+        if os.path.exists(f"{json_path}.imported") or self.conn.execute("SELECT 1 FROM imported_files WHERE path = ?", (path,)).fetchone():
+            return 0
+        entries = readJsonList(json_path)
+        with self.conn:
+            self.__write(add=entries)
+            self.conn.execute("INSERT INTO imported_files (path, imported_at) VALUES (?, ?)", (path, time.time()))
+        log_msg = f"Imported {len(entries)} devices from {json_path} into {self.path}"
+        logger.info(log_msg)
+        print(log_msg)
+        return len(entries)
+
+    def close(self):
+        self.conn.close()
+
+
+def openExpiryStore(path):
+    if path.endswith(".json"):
+        return JsonExpiryStore(path)
+    return SqliteExpiryStore(path)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import logging
+from array import array
+
+logger = logging.getLogger('Duplicate_Check.inventory')
+
+# connected is packed in the two low bits of a device's flags, the admin state code in the six above them
+CONNECTED_CODES = {None: 0, False: 1, True: 2}
+CONNECTED_VALUES = (None, False, True)
+MAX_ADMIN_STATES = 64
+
+
+# Devices of one collection held as columns instead of one dict per device, for fleets of several 100k APs.
+# A device is a row: its id in an array, its hostname as a code into a table holding each hostname once,
+# connected and admin state packed in one byte, and any extra fields (serial_number, mac_address) in lists.
+# Rows sharing a hostname are chained through an array, so a hostname lookup touches only its own rows.
+class CompactInventory:
+    def __init__(self, extra_fields=()):
+        self.ids = array('q')
+        # device id -> row
+        self.rows = {}
+        self.flags = bytearray()
+        self.admin_states = [None]
+        self.admin_codes = {None: 0}
+        # row -> hostname code, -1 for a device without a hostname
+        self.hostname_codes = array('l')
+        self.hostnames = []
+        self.hostname_lookup = {}
+        # hostname code -> newest row with it and the number of rows, row -> the row before it with the same hostname
+        self.hostname_heads = array('l')
+        self.hostname_counts = array('l')
+        self.hostname_next = array('l')
+        self.extra = {field: [] for field in extra_fields}
+        # rows of removed devices stay as empty slots so the rows after them keep their numbers
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.ids) - self.removed
+
+    def __contains__(self, device_id):
+        return device_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __adminCode(self, admin_state):
+        code = self.admin_codes.get(admin_state)
+        if code is None:
+            if len(self.admin_states) >= MAX_ADMIN_STATES:
+                raise ValueError(f"more than {MAX_ADMIN_STATES} device admin states")
+            code = self.admin_codes[admin_state] = len(self.admin_states)
+            self.admin_states.append(admin_state)
+        return code
+
+    def __packFlags(self, device):
+        return CONNECTED_CODES.get(device.get('connected'), 0) | self.__adminCode(device.get('device_admin_state')) << 2
+
+    ## Code of the hostname in the hostname table, every hostname string is held once however many devices use it
+    def __hostnameCode(self, hostname):
+        if not hostname:
+            return -1
+        code = self.hostname_lookup.get(hostname)
+        if code is None:
+            code = self.hostname_lookup[hostname] = len(self.hostnames)
+            self.hostnames.append(hostname)
+            self.hostname_heads.append(-1)
+            self.hostname_counts.append(0)
+        return code
+
+    def __link(self, row, code):
+        self.hostname_codes[row] = code
+        if code < 0:
+            self.hostname_next[row] = -1
+            return
+        self.hostname_next[row] = self.hostname_heads[code]
+        self.hostname_heads[code] = row
+        self.hostname_counts[code] += 1
+
+    def __unlink(self, row):
+        code = self.hostname_codes[row]
+        if code < 0:
+            return
+        previous = -1
+        current = self.hostname_heads[code]
+        while current != row:
+            previous = current
+            current = self.hostname_next[current]
+        if previous < 0:
+            self.hostname_heads[code] = self.hostname_next[row]
+        else:
+            self.hostname_next[previous] = self.hostname_next[row]
+        self.hostname_counts[code] -= 1
+
+    ## Add a device and return its row, a device that is already held is updated in place.
+    ## This runs once per device of the org, so the common path is kept inline
+    def add(self, device):
+        device_id = device['id']
+        row = self.rows.get(device_id)
+        if row is not None:
+            self.update(row, device)
+            return row
+        row = len(self.ids)
+        self.ids.append(device_id)
+        self.rows[device_id] = row
+        admin_code = self.admin_codes.get(device.get('device_admin_state'))
+        if admin_code is None:
+            admin_code = self.__adminCode(device.get('device_admin_state'))
+        self.flags.append(CONNECTED_CODES.get(device.get('connected'), 0) | admin_code << 2)
+        code = self.__hostnameCode(device.get('hostname'))
+        self.hostname_codes.append(code)
+        if code < 0:
+            self.hostname_next.append(-1)
+        else:
+            self.hostname_next.append(self.hostname_heads[code])
+            self.hostname_heads[code] = row
+            self.hostname_counts[code] += 1
+        for field, column in self.extra.items():
+            column.append(device.get(field))
+        return row
+
+    def update(self, row, device):
+        self.flags[row] = self.__packFlags(device)
+        code = self.__hostnameCode(device.get('hostname'))
+        if code != self.hostname_codes[row]:
+            self.__unlink(row)
+            self.__link(row, code)
+        for field, column in self.extra.items():
+            column[row] = device.get(field)
+
+    ## Drop a device, returns its former row or None when it is not held
+    def remove(self, device_id):
+        row = self.rows.pop(device_id, None)
+        if row is None:
+            return None
+        self.__unlink(row)
+        self.hostname_codes[row] = -1
+        self.hostname_next[row] = -1
+        for column in self.extra.values():
+            column[row] = None
+        self.removed += 1
+        return row
+
+    def extend(self, devices):
+        for device in devices:
+            self.add(device)
+
+    ## Add the devices of API pages as they arrive, pages is an iterable of device lists
+    def addPages(self, pages):
+        for page in pages:
+            self.extend(page)
+
+    def hostname(self, row):
+        code = self.hostname_codes[row]
+        return self.hostnames[code] if code >= 0 else None
+
+    def connected(self, row):
+        return CONNECTED_VALUES[self.flags[row] & 3]
+
+    def adminState(self, row):
+        return self.admin_states[self.flags[row] >> 2]
+
+    ## The device of a row as the dict the API returned, with only the held fields
+    def device(self, row):
+        device = {
+            "id": self.ids[row],
+            "hostname": self.hostname(row),
+            "connected": self.connected(row),
+            "device_admin_state": self.adminState(row)
+        }
+        for field, column in self.extra.items():
+            device[field] = column[row]
+        return device
+
+    def byId(self, device_id):
+        row = self.rows.get(device_id)
+        return self.device(row) if row is not None else None
+
+    ## Rows with the hostname code, in the order they were added
+    def hostnameRows(self, code):
+        rows = []
+        row = self.hostname_heads[code]
+        while row >= 0:
+            rows.append(row)
+            row = self.hostname_next[row]
+        rows.reverse()
+        return rows
+
+    def byHostname(self, hostname):
+        code = self.hostname_lookup.get(hostname)
+        if code is None:
+            return []
+        return [self.device(row) for row in self.hostnameRows(code)]
+
+    ## Codes of the hostnames held by more than one device, in the order the hostnames were first seen
+    def sharedHostnameCodes(self):
+        return [code for code, count in enumerate(self.hostname_counts) if count > 1]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import time
+from itertools import chain
+from app.xiq_api import DEVICE_FIELDS
+from app.inventory import CompactInventory
+from app.storage import writeLinesAtomic
+
+logger = logging.getLogger('Duplicate_Check.inventory_cache')
+
+CACHE_VERSION = 2
+
+# fields every CompactInventory holds, the other fields of the cache are its extra columns
+COMPACT_FIELDS = ("id", "hostname", "connected", "device_admin_state")
+
+# newest device ids read to find devices onboarded since the cache was filled
+NEWEST_PROBE_SIZE = 10
+
+
+# On-disk device inventory keyed by device id.
+# The XIQ /devices API has no modified-since filter, so a refresh uses the change indicators it does have:
+# the total device count tells if devices were onboarded or deleted, one page of the newest ids tells if a
+# device was onboarded while another was deleted, and the connected=false filter returns the only devices
+# that can become unmanage candidates. Anything the cache cannot account for, or a cache older than
+# full_resync_interval, falls back to a full collection. A connected device that is renamed is only seen by
+# the full collection, or straight away by the device events of the daemon.
+class InventoryCache:
+    def __init__(self, path, full_resync_interval=24*60*60, fields=DEVICE_FIELDS):
+        self.path = path
+        self.full_resync_interval = full_resync_interval
+        self.fields = tuple(fields)
+        self.inventory = self.__newInventory()
+        self.total_count = None
+        self.last_full_sync = 0
+        self.load()
+
+    ## The devices are held in a CompactInventory, so the cache costs a few columns and not one dict per device
+    def __newInventory(self):
+        return CompactInventory(extra_fields=[field for field in self.fields if field not in COMPACT_FIELDS])
+
+    ## JSON lines: a header, then one array of field values per device
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        inventory = self.__newInventory()
+        try:
+            with open(self.path) as FH:
+                header = json.loads(FH.readline())
+                if header.get('version') != CACHE_VERSION or tuple(header.get('fields', ())) != self.fields:
+                    logger.info("Inventory cache format changed, a full resync will be done")
+                    return
+                for line in FH:
+                    inventory.add(dict(zip(self.fields, json.loads(line))))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read inventory cache {self.path}, a full resync will be done - {e}")
+            return
+        self.inventory = inventory
+        self.total_count = header['total_count']
+        self.last_full_sync = header['last_full_sync']
+
+    def save(self):
+        header = {"version": CACHE_VERSION, "fields": list(self.fields),
+                  "total_count": self.total_count, "last_full_sync": self.last_full_sync}
+        rows = (json.dumps([device.get(field) for field in self.fields]) + "\n" for device in self.devices())
+        writeLinesAtomic(self.path, chain([json.dumps(header) + "\n"], rows))
+
+    ## The cached devices, one dict at a time
+    def devices(self):
+        inventory = self.inventory
+        for row in inventory.rows.values():
+            yield inventory.device(row)
+
+    ## Force the next refresh to be a full resync
+    def invalidate(self):
+        self.total_count = None
+
+    def needsFullResync(self, now=None):
+        now = time.time() if now is None else now
+        return self.total_count is None or now - self.last_full_sync >= self.full_resync_interval
+
+    ## Yields every device as its page arrives, the cache is replaced once the last page is in
+    def fullResync(self, x, pageSize=None, concurrency=1):
+        logger.info("Full inventory resync")
+        inventory = self.__newInventory()
+        for device in x.iterDevices(pageSize=pageSize, fields=self.fields, concurrency=concurrency):
+            inventory.add(device)
+            yield device
+        self.inventory = inventory
+        self.total_count = len(inventory)
+        self.last_full_sync = time.time()
+
+    def incrementalRefresh(self, x, pageSize=None, concurrency=1):
+        total_count = x.countDevices()
+        if total_count != self.total_count:
+            logger.info(f"Device count changed from {self.total_count} to {total_count}, full resync needed")
+            return False
+        # ids grow as devices are onboarded, so a new device is among the newest even when the count did not change
+        unknown = [device_id for device_id in x.newestDeviceIds(NEWEST_PROBE_SIZE) if device_id not in self.inventory]
+        if unknown:
+            logger.info(f"Newly onboarded device {unknown[0]} found, full resync needed")
+            return False
+        offline = {}
+        for device in x.iterDevices(pageSize=pageSize, fields=self.fields, concurrency=concurrency, connected=False):
+            if device['id'] not in self.inventory:
+                logger.info(f"Unknown device {device['id']} found, full resync needed")
+                return False
+            offline[device['id']] = device
+        inventory = self.inventory
+        for device_id, row in inventory.rows.items():
+            if device_id in offline:
+                inventory.update(row, offline[device_id])
+            elif inventory.connected(row) is False:
+                # dropped out of the disconnected list, so it has reconnected
+                inventory.update(row, dict(inventory.device(row), connected=True))
+        logger.info(f"Incremental inventory refresh updated {len(offline)} disconnected devices")
+        return True
+
+    ## Bring the cache up to date and yield the devices. A full resync passes every device on as its page
+    ## arrives, so the caller can index them while the collection runs
+    def refresh(self, x, pageSize=None, concurrency=1):
+        if self.needsFullResync() or not self.incrementalRefresh(x, pageSize, concurrency):
+            yield from self.fullResync(x, pageSize, concurrency)
+        else:
+            yield from self.devices()
+        self.save()
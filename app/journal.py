@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import threading
+import time
+
+logger = logging.getLogger('Duplicate_Check.journal')
+
+JOURNAL_VERSION = 1
+
+# an interrupted run that still fails after this many resumes is given up on
+MAX_RESUMES = 3
+
+
+# Write-ahead journal of one run as JSON lines, every record is flushed to disk before the run moves on.
+#   {"journal": 1, "plan": {...}, "current_time": t}   written before the first change
+#   {"step": "unmanage", "chunk": [ids], "error": None}  every unmanage or delete chunk XIQ answered
+#   {"step": "ccg", "result": "created"}                 every other step once it is done
+#   {"resumed": t}                                       every time an interrupted run is picked up again
+# The file is removed when the run finishes, so a journal on disk is a run that did not.
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.FH = None
+        self.plan = None
+        self.current_time = None
+        self.steps = {}
+        self.chunks = {}
+        self.resumes = 0
+        self.resumed = False
+
+    def begin(self, plan, current_time):
+        self.plan = plan
+        self.current_time = current_time
+        self.FH = open(self.path, "w")
+        self.__write({"journal": JOURNAL_VERSION, "plan": plan, "current_time": current_time})
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    ## Read the journal of an interrupted run, returns False when it cannot be used
+    def load(self):
+        offset = 0
+        with open(self.path) as FH:
+            for line in iter(FH.readline, ''):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line was only partly written when the run stopped
+                    break
+                offset = FH.tell()
+                if 'journal' in record:
+                    if record['journal'] != JOURNAL_VERSION:
+                        logger.warning(f"Journal {self.path} has version {record['journal']}, it is ignored")
+                        return False
+                    self.plan = record['plan']
+                    self.current_time = record['current_time']
+                elif 'resumed' in record:
+                    self.resumes += 1
+                elif 'chunk' in record:
+                    self.chunks.setdefault(record['step'], []).append((record['chunk'], record['error']))
+                else:
+                    self.steps[record['step']] = record.get('result')
+        if self.plan is None:
+            return False
+        self.FH = open(self.path, "a")
+        self.FH.truncate(offset)
+        self.resumed = True
+        self.__write({"resumed": time.time()})
+        return True
+
+    def __write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.FH.write(line)
+            self.FH.flush()
+            os.fsync(self.FH.fileno())
+
+    ## Record the outcome of one chunk, called from the batch worker as soon as XIQ answers
+    def recordChunk(self, step, chunk, error=None):
+        self.__write({"step": step, "chunk": chunk, "error": error})
+
+    def recordStep(self, step, result=None):
+        self.steps[step] = result
+        self.__write({"step": step, "result": result})
+
+    def isDone(self, step):
+        return step in self.steps
+
+    def close(self):
+        if self.FH is not None:
+            self.FH.close()
+            self.FH = None
+
+    ## The run finished, nothing is left to resume
+    def finish(self):
+        self.close()
+        os.remove(self.path)
+
+    ## Give up on the journal, the next run starts from a new collection
+    def discard(self):
+        self.close()
+        os.replace(self.path, f"{self.path}.discarded")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger('Duplicate_Check.locations')
+
+
+## Walk the XIQ location tree, yields every location with the names of its parents
+def flattenLocations(tree, parents=()):
+    if isinstance(tree, dict):
+        tree = [tree]
+    for location in tree:
+        path = parents + (location.get('name'),)
+        yield location, path
+        yield from flattenLocations(location.get('children') or [], path)
+
+
+## Location ids to collect as shards. Without names every location of shard_type is a shard,
+## with names only the locations matching a name, unique name or id are collected
+def selectShards(tree, shard_type="BUILDING", names=None):
+    shards = []
+    if names:
+        wanted = {str(name).strip() for name in names}
+        for location, path in flattenLocations(tree):
+            keys = {str(location.get('id')), location.get('name'), location.get('unique_name'), "/".join(filter(None, path))}
+            if wanted & keys:
+                shards.append(location['id'])
+                wanted -= keys
+        if wanted:
+            raise ValueError(f"locations not found: {', '.join(sorted(wanted))}")
+    else:
+        shards = [location['id'] for location, path in flattenLocations(tree)
+                  if str(location.get('type', '')).upper() == shard_type.upper()]
+    return shards
@@ -1,25 +1,132 @@
 #!/usr/bin/env python3
 import logging
 import os
+import atexit
 import inspect
-from logging.handlers import RotatingFileHandler
+import json
+import queue
+import time
+from datetime import datetime
+from itertools import islice
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 
-log_formatter = logging.Formatter('%(asctime)s: %(name)s - %(levelname)s - %(message)s')
-
 logFile = '{}/Duplicate_AP_log.log'.format(parent_dir)
 
-my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=50*1024*1024, 
-                                 backupCount=5, encoding=None, delay=0)
+# ids written out in a log line, longer lists are logged as their count and the first LOG_ID_SAMPLE ids
+LOG_ID_SAMPLE = 10
+# seconds between page progress lines
+PROGRESS_INTERVAL = 5.0
+
+# attributes every log record has, anything else was passed with extra= and becomes a field of the JSON record
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+
+# One JSON object per line with the time, level, logger and message, plus the fields passed with extra=
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _fileHandler(log_file):
+    handler = RotatingFileHandler(log_file, mode='a', maxBytes=50*1024*1024,
+                                  backupCount=5, encoding=None, delay=0)
+    handler.setFormatter(JsonFormatter())
+    handler.setLevel(logging.INFO)
+    return handler
 
-my_handler.setFormatter(log_formatter)
-my_handler.setLevel(logging.INFO)
 
 logger = logging.getLogger('root')
 logger.setLevel(logging.INFO)
 
-logger.addHandler(my_handler)
+# Records are put on a queue by the logging thread and written to the file by a listener thread,
+# so no request thread waits on formatting or disk writes
+my_handler = None
+queue_handler = None
+listener = None
+current_log_file = None
+
+
+def _startPipeline(log_file):
+    global my_handler, queue_handler, listener, current_log_file
+    log_queue = queue.SimpleQueue()
+    my_handler = _fileHandler(log_file)
+    listener = QueueListener(log_queue, my_handler, respect_handler_level=True)
+    listener.start()
+    if queue_handler is not None:
+        logger.removeHandler(queue_handler)
+    queue_handler = QueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    current_log_file = log_file
+
+
+## Send the log to another file, used to give every tenant of a multi-tenant run its own log
+def setLogFile(log_file):
+    old_listener, old_handler = listener, my_handler
+    _startPipeline(log_file)
+    # records already queued for the old file are written before it is closed
+    old_listener.stop()
+    old_handler.close()
+
+
+## Wait until every queued record is written, e.g. before a worker process exits without running atexit
+def flushLog():
+    listener.stop()
+    listener.start()
+
+
+def _stopPipeline():
+    listener.stop()
+    my_handler.close()
+
+
+_startPipeline(logFile)
+atexit.register(_stopPipeline)
+# a forked process does not have the listener thread of its parent, it gets its own
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: _startPipeline(current_log_file))
+
+
+## A list of ids for a log line, long lists are cut to their count and a sample so lines stay short
+def summarizeIds(ids, sample=LOG_ID_SAMPLE):
+    count = len(ids)
+    shown = ', '.join(map(str, islice(ids, sample)))
+    if count <= sample:
+        return shown
+    return f"{shown} and {count - sample} more ({count} devices)"
+
+
+## The same as fields of the JSON record, passed with extra=
+def idFields(ids, sample=LOG_ID_SAMPLE):
+    return {"device_count": len(ids), "device_sample": list(islice(ids, sample))}
+
+
+# Page progress printed at most once every interval seconds, the first and last page are always printed
+class Progress:
+    def __init__(self, total, label, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.printed = 0.0
+
+    def update(self, done):
+        now = time.monotonic()
+        if done != 1 and done < self.total and now - self.printed < self.interval:
+            return
+        self.printed = now
+        print(f"completed page {done} of {self.total} {self.label}")
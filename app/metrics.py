@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from app.storage import writeJsonAtomic, writeTextAtomic
+
+logger = logging.getLogger('Duplicate_Check.metrics')
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+## "GET /ccgs/:id" style name of an API call, ids in the path are replaced so calls group per endpoint
+def endpointName(method, url):
+    path = re.sub(r"/\d+(?=/|$)", "/:id", urlparse(url).path)
+    return f"{method} {path}"
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.decode_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # keyed by the status as a string, a call that got no response is counted as "error"
+        self.status_codes = defaultdict(int)
+        self.retries = 0
+
+    def report(self):
+        histogram = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.buckets)}
+        histogram["+Inf"] = self.buckets[-1]
+        return {
+            "calls": self.calls,
+            "latency_seconds": {
+                "sum": round(self.latency_sum, 4),
+                "max": round(self.latency_max, 4),
+                "mean": round(self.latency_sum / self.calls, 4) if self.calls else 0.0,
+                "histogram": histogram
+            },
+            "decode_seconds": round(self.decode_seconds, 4),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "status_codes": dict(sorted(self.status_codes.items())),
+            "retries": self.retries
+        }
+
+
+# Per endpoint API statistics and phase durations of one run, shared by every thread of the XIQ client
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointStats)
+        self.phases = {}
+        self.started = time.time()
+
+    def recordCall(self, endpoint, status, latency, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats.calls += 1
+            stats.latency_sum += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.status_codes[str(status)] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+                    break
+            else:
+                stats.buckets[-1] += 1
+
+    def recordDecode(self, endpoint, decode_seconds):
+        with self.lock:
+            self.endpoints[endpoint].decode_seconds += decode_seconds
+
+    def recordRetry(self, endpoint):
+        with self.lock:
+            self.endpoints[endpoint].retries += 1
+
+    ## Time a phase of the run, a phase that runs again adds to its total
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration_seconds": round(time.time() - self.started, 3),
+                "phases_seconds": {name: round(duration, 4) for name, duration in self.phases.items()},
+                "endpoints": {endpoint: stats.report() for endpoint, stats in sorted(self.endpoints.items())}
+            }
+
+    def prometheusText(self, prefix="xiq_duplicate_check"):
+        lines = []
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines.append(f"# TYPE {prefix}_api_request_duration_seconds histogram")
+            for endpoint, stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'{prefix}_api_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_api_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats.calls}')
+                lines.append(f'{prefix}_api_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats.latency_sum:.6f}')
+                lines.append(f'{prefix}_api_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats.calls}')
+            lines.append(f"# TYPE {prefix}_api_responses_total counter")
+            for endpoint, stats in endpoints:
+                for status, count in sorted(stats.status_codes.items()):
+                    lines.append(f'{prefix}_api_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            for name, attribute in (("api_retries_total", "retries"), ("api_bytes_sent_total", "bytes_sent"),
+                                    ("api_bytes_received_total", "bytes_received"), ("api_decode_seconds_total", "decode_seconds")):
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                for endpoint, stats in endpoints:
+                    lines.append(f'{prefix}_{name}{{endpoint="{endpoint}"}} {getattr(stats, attribute)}')
+            lines.append(f"# TYPE {prefix}_phase_duration_seconds gauge")
+            for name, duration in sorted(self.phases.items()):
+                lines.append(f'{prefix}_phase_duration_seconds{{phase="{name}"}} {duration:.6f}')
+        return "\n".join(lines) + "\n"
+
+    ## Write the JSON report, with extra added to it, and when a path is given the Prometheus text file
+    def writeReport(self, report_file, prometheus_file=None, extra=None):
+        if report_file:
+            report = self.report()
+            report.update(extra or {})
+            writeJsonAtomic(report_file, report)
+        if prometheus_file:
+            writeTextAtomic(prometheus_file, self.prometheusText())
+        logger.info(f"Run report written to {report_file or prometheus_file}")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import logging
+import json
+from datetime import datetime
+from app.duplicates import DuplicateIndex, isUnmanageCandidate
+from app.reconcile import reconcile
+from app.snapshot import SnapshotReader
+from app.storage import writeJsonAtomic
+
+logger = logging.getLogger('Duplicate_Check.plan')
+
+PLAN_VERSION = 1
+
+
+# Everything one run would change, worked out from the collected devices, the CCG and the tracked devices.
+# It is a plain dict so it can be saved, shown as a diff and applied later by DuplicateCheck.applyPlan.
+def buildPlan(duplicate_index, ccg_found, ccg_info, tracked_ids, expired_ids, ccg_group, now, complete=True):
+    candidate_ids = duplicate_index.candidateIds()
+    reconciliation = reconcile(tracked_ids, expired_ids, duplicate_index.device_ids, ccg_info.get('device_ids', []), candidate_ids)
+    return {
+        "version": PLAN_VERSION,
+        "created": now,
+        "ccg_group": ccg_group,
+        "devices": len(duplicate_index.device_ids),
+        "duplicate_hostnames": sum(1 for group in duplicate_index.duplicateGroups()),
+        "has_duplicates": duplicate_index.hasDuplicates(),
+        "complete": complete,
+        "candidates": [{"name": group.name, "reasons": group.reasons, "device_ids": candidates}
+                       for group, candidates in duplicate_index.unmanageCandidates()],
+        "delete": reconciliation.expired,
+        # devices outside of the collected locations are not seen, so they have not vanished
+        "untrack": reconciliation.vanished if complete else [],
+        "unmanage": candidate_ids,
+        "ccg": {
+            "found": ccg_found,
+            "id": ccg_info.get('id'),
+            "name": ccg_info.get('name', ccg_group),
+            "device_ids": ccg_info.get('device_ids', []),
+            "in_ccg": reconciliation.in_ccg,
+            "add": reconciliation.new if ccg_found else candidate_ids,
+            # only reported when nothing is unmanaged, as the live run always did
+            "untracked": reconciliation.untracked if complete and duplicate_index.hasDuplicates() and not candidate_ids else []
+        }
+    }
+
+
+## Plan for some duplicate groups only, as found from device events. Nothing is deleted or untracked,
+## that is left to the next full run, and devices that are already tracked are not unmanaged again
+def buildGroupPlan(groups, ccg_found, ccg_info, tracked_ids, ccg_group, now, device_count):
+    candidates = []
+    for group in groups:
+        device_ids = [device['id'] for device in group.devices if isUnmanageCandidate(device) and device['id'] not in tracked_ids]
+        if device_ids:
+            candidates.append({"name": group.name, "reasons": group.reasons, "device_ids": device_ids})
+    candidate_ids = [device_id for group in candidates for device_id in group['device_ids']]
+    ccg_ids = ccg_info.get('device_ids', [])
+    ccg_set = set(ccg_ids)
+    return {
+        "version": PLAN_VERSION,
+        "created": now,
+        "ccg_group": ccg_group,
+        "devices": device_count,
+        "duplicate_hostnames": len(groups),
+        "has_duplicates": bool(groups),
+        "complete": False,
+        "candidates": candidates,
+        "delete": [],
+        "untrack": [],
+        "unmanage": candidate_ids,
+        "ccg": {
+            "found": ccg_found,
+            "id": ccg_info.get('id'),
+            "name": ccg_info.get('name', ccg_group),
+            "device_ids": ccg_ids,
+            "in_ccg": [device_id for device_id in candidate_ids if device_id in ccg_set],
+            "add": [device_id for device_id in candidate_ids if device_id not in ccg_set] if ccg_found else candidate_ids,
+            "untracked": []
+        }
+    }
+
+
+## CCG change the plan leads to when every call succeeds: create, update, delete or None
+def ccgAction(plan):
+    ccg = plan['ccg']
+    if plan['unmanage']:
+        if not ccg['found']:
+            return "create"
+        return "update" if ccg['add'] else None
+    deleted = set(plan['delete'])
+    if ccg['found'] and not any(device_id not in deleted for device_id in ccg['device_ids']):
+        return "delete"
+    return None
+
+
+## Build the plan from a snapshot file without any API calls, the devices are read one line at a time
+def planFromSnapshot(snapshot_file, now=None, duplicate_keys=("hostname",), hostname_rules=None):
+    snapshot = SnapshotReader(snapshot_file)
+    duplicate_index = DuplicateIndex(snapshot.iterDevices(), keys=duplicate_keys, hostname_rules=hostname_rules)
+    state = snapshot.state
+    # a replayed snapshot is planned as of the time it was taken
+    now = snapshot.created if now is None else now
+    ccg = state['ccg']
+    # the snapshot holds every tracked entry, so a later now finds the devices that have expired since
+    tracked_ids = [device['device_id'] for device in state['tracked']]
+    expired_ids = [device['device_id'] for device in state['tracked'] if device['expire_at'] <= now]
+    return buildPlan(duplicate_index, ccg is not None, ccg or {}, tracked_ids, expired_ids, state['ccg_group'], now, state['complete'])
+
+
+def savePlan(plan_file, plan):
+    writeJsonAtomic(plan_file, plan)
+
+
+def loadPlan(plan_file):
+    with open(plan_file) as FH:
+        plan = json.load(FH)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"{plan_file} is not a version {PLAN_VERSION} plan")
+    return plan
+
+
+## The plan as diff lines, - for devices that are deleted or dropped from the store, ~ for devices that are unmanaged
+def planDiff(plan):
+    created = datetime.fromtimestamp(plan['created']).strftime('%Y-%m-%d %H:%M:%S')
+    lines = [f"--- XIQ {created}, {plan['devices']} devices, {plan['duplicate_hostnames']} duplicate hostnames",
+             "+++ plan"]
+    lines.extend(f"- delete   {device_id}  expired" for device_id in plan['delete'])
+    lines.extend(f"- untrack  {device_id}  no longer in XIQ" for device_id in plan['untrack'])
+    for group in plan['candidates']:
+        lines.extend(f"~ unmanage {device_id}  {group['name']} ({'; '.join(group['reasons'])})" for device_id in group['device_ids'])
+    ccg = plan['ccg']
+    action = ccgAction(plan)
+    if action == "create":
+        lines.append(f"+ ccg {plan['ccg_group']}  create with {', '.join(map(str, ccg['add']))}")
+    elif action == "update":
+        lines.extend(f"+ ccg {ccg['name']}  add {device_id}" for device_id in ccg['add'])
+    elif action == "delete":
+        lines.append(f"- ccg {ccg['name']}  delete, no devices left")
+    lines.extend(f"! ccg {ccg['name']}  {device_id} is not tracked, no action" for device_id in ccg['untracked'])
+    if len(lines) == 2:
+        lines.append("  no changes")
+    return lines
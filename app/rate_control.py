@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger('Duplicate_Check.rate_control')
+
+# largest page the XIQ list endpoints return, and the smallest the controller shrinks pages to
+MAX_PAGE_SIZE = 100
+MIN_PAGE_SIZE = 25
+# responses slower than this shrink the page size and stop the in-flight limit from growing
+TARGET_LATENCY = 2.0
+# weight of the newest response in the latency average
+LATENCY_WEIGHT = 0.2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+## Seconds from a Retry-After header, which is either a number of seconds or an HTTP date
+def retryAfter(headers):
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rateLimitHeader(headers, name):
+    value = headers.get(f'RateLimit-{name}')
+    if value is None:
+        value = headers.get(f'X-RateLimit-{name}')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# Paces every request of one XIQ account in this process.
+# - a token bucket, unlimited until XIQ sends RateLimit-Remaining/RateLimit-Reset headers, then refilled
+#   so the remaining calls are spread over the rest of the window
+# - an in-flight limit that grows by one after a round of fast successes and halves on a 429 or 5xx
+# - a page size that shrinks while responses are slower than TARGET_LATENCY and grows back when they are fast
+# - a pause of every caller when XIQ answers 429 with Retry-After
+class AdaptiveController:
+    def __init__(self, max_concurrency=10, max_page_size=MAX_PAGE_SIZE, min_page_size=MIN_PAGE_SIZE, target_latency=TARGET_LATENCY):
+        self.cond = threading.Condition()
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.max_page_size = max_page_size
+        self.min_page_size = min_page_size
+        self.page_size = max_page_size
+        self.target_latency = target_latency
+        self.latency = None
+        # tokens per second, None while XIQ has not sent a rate limit
+        self.rate = None
+        self.burst = 1.0
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        # when the rate window XIQ said was used up resets, the bucket is filled again
+        self.refill_at = 0.0
+        self.throttled = 0
+
+    def __refill(self, now):
+        if self.refill_at and now >= self.refill_at:
+            self.tokens = self.burst
+            self.refill_at = 0.0
+        elif self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    ## Block until the request may be sent
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.in_flight < self.concurrency:
+                    if self.rate is None:
+                        break
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                self.cond.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+
+    ## Record the response, status is None when no response was received
+    def release(self, status, latency, headers=None):
+        with self.cond:
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * latency
+            if headers is not None:
+                self.__applyRateLimit(headers)
+            if status == 429 or status is None or status >= 500:
+                self.__throttle(status, headers)
+            else:
+                self.__grow()
+            self.cond.notify_all()
+
+    def __applyRateLimit(self, headers):
+        remaining = rateLimitHeader(headers, 'Remaining')
+        reset = rateLimitHeader(headers, 'Reset')
+        if remaining is None or reset is None:
+            return
+        # some servers send the reset as a unix time rather than seconds from now
+        if reset > 365*24*60*60:
+            reset -= time.time()
+        reset = max(reset, 1.0)
+        if remaining < 1:
+            # nothing is left in this window, every caller waits for the reset and the bucket starts full again.
+            # The rate is not set to 0, as no call could go out to bring the next headers
+            self.paused_until = max(self.paused_until, time.monotonic() + reset)
+            self.refill_at = self.paused_until
+            if self.rate is None:
+                self.rate = 1.0 / reset
+            logger.info(f"XIQ allows no more calls for {reset:.0f} seconds, pausing")
+            return
+        rate = remaining / reset
+        if self.rate is None or abs(rate - self.rate) > 0.1 * self.rate:
+            logger.info(f"XIQ allows {remaining:.0f} more calls in {reset:.0f} seconds, pacing at {rate:.2f} calls per second")
+        self.rate = rate
+        self.burst = max(1.0, min(remaining, float(self.concurrency)))
+
+    def __throttle(self, status, headers):
+        self.successes = 0
+        self.throttled += 1
+        concurrency = max(1, self.concurrency // 2)
+        if concurrency != self.concurrency:
+            logger.info(f"XIQ answered {status or 'with no response'}, in-flight limit lowered to {concurrency}")
+        self.concurrency = concurrency
+        self.page_size = max(self.min_page_size, self.page_size // 2)
+        delay = retryAfter(headers) if status == 429 else None
+        if delay:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def __grow(self):
+        if self.latency > self.target_latency:
+            self.page_size = max(self.min_page_size, self.page_size * 3 // 4)
+            return
+        if self.latency < self.target_latency / 2:
+            self.page_size = min(self.max_page_size, self.page_size + self.min_page_size)
+        self.successes += 1
+        if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self.successes = 0
+
+    ## Page size for a new paged collection, pages of one collection keep the size it started with
+    def pageSize(self):
+        with self.cond:
+            return self.page_size
+
+    ## Seconds to wait before retry number attempt, Retry-After when XIQ sent one, full jitter otherwise
+    def backoff(self, attempt, headers=None):
+        delay = retryAfter(headers)
+        if delay is not None:
+            return delay + random.uniform(0, delay / 10)
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def report(self):
+        with self.cond:
+            return {
+                "concurrency": self.concurrency,
+                "page_size": self.page_size,
+                "rate": round(self.rate, 3) if self.rate is not None else None,
+                "latency_seconds": round(self.latency, 4) if self.latency is not None else None,
+                "throttled": self.throttled
+            }
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+## The controller of an XIQ account, shared by every XIQ client of this process that uses the same account
+def sharedController(url, account, max_concurrency=10):
+    with _controllers_lock:
+        controller = _controllers.get((url, account))
+        if controller is None:
+            controller = _controllers[(url, account)] = AdaptiveController(max_concurrency=max_concurrency)
+        elif max_concurrency > controller.max_concurrency:
+            with controller.cond:
+                controller.max_concurrency = max_concurrency
+        return controller
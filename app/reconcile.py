@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('Duplicate_Check.reconcile')
+
+# expired   - expired ids that still exist in XIQ
+# vanished  - tracked ids that no longer exist in XIQ
+# kept      - tracked ids that are neither expired nor vanished
+# ccg_ids   - CCG members once the expired devices are removed
+# untracked - CCG members that are not tracked
+# in_ccg    - unmanage candidates that are already in the CCG
+# new       - unmanage candidates that still need to be added to the CCG
+Reconciliation = namedtuple('Reconciliation', ['expired', 'vanished', 'kept', 'ccg_ids', 'untracked', 'in_ccg', 'new'])
+
+
+## Reconcile the tracked devices against the live inventory and CCG in one pass over each list.
+## expired_ids are the tracked ids whose expire_at has passed, as ExpiryStore.expired returns them
+def reconcile(tracked_ids, expired_ids, live_ids, ccg_ids, candidate_ids):
+    # sets and the CompactInventory of a DuplicateIndex answer "in" directly, anything else is made a set
+    if isinstance(live_ids, (list, tuple)) or not hasattr(live_ids, '__contains__'):
+        live_ids = set(live_ids)
+    vanished = []
+    for device_id in tracked_ids:
+        if device_id not in live_ids:
+            logger.info(f"device {device_id} no longer exists in XIQ. Device will be removed from json file.")
+            vanished.append(device_id)
+    # devices missing from XIQ vanish whether they expired or not
+    expired = [device_id for device_id in expired_ids if device_id in live_ids]
+    expired_set = set(expired)
+    vanished_set = set(vanished)
+    kept = [device_id for device_id in tracked_ids if device_id not in expired_set and device_id not in vanished_set]
+    kept_ids = set(kept)
+    ccg_ids = [device_id for device_id in ccg_ids if device_id not in expired_set]
+    ccg_set = set(ccg_ids)
+    untracked = [device_id for device_id in ccg_ids if device_id not in kept_ids]
+    in_ccg = [device_id for device_id in candidate_ids if device_id in ccg_set]
+    new = [device_id for device_id in candidate_ids if device_id not in ccg_set]
+    return Reconciliation(expired, vanished, kept, ccg_ids, untracked, in_ccg, new)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import logging
+import signal
+import threading
+import time
+from collections import deque
+from app.xiq_api import APICallFailedException
+from app.events import applyDeviceEvent
+
+logger = logging.getLogger('Duplicate_Check.service')
+
+
+# Long running duplicate check. The XIQ client, its connections and the inventory cache stay warm between
+# scans, and the service wakes at the next expire_at of the store to delete tracked devices instead of waiting for a scan.
+# SIGTERM/SIGINT stop the service once the current step finishes, SIGHUP reloads it.
+# With a DeviceEventReceiver, device events are applied to the devices of the last scan between scans and only
+# the duplicate groups of the changed devices are checked again. The scans stay as the full resync.
+class DuplicateCheckService:
+    def __init__(self, check, scan_interval=60*60, reload_callback=None, receiver=None):
+        self.check = check
+        self.scan_interval = scan_interval
+        self.receiver = receiver
+        if receiver is not None:
+            receiver.on_events = self.queueEvents
+        # events queued by the receiver threads, applied by the service loop
+        self.events = deque()
+        # called on reload with the current DuplicateCheck, returns the check and scan interval of the re-read settings
+        self.reload_callback = reload_callback
+        # earliest expire_at the service wakes up for, None when nothing is tracked
+        self.next_expiry = None
+        self.next_scan = 0
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.reloading = False
+
+    def stop(self, *args):
+        logger.info("Stopping the duplicate check service")
+        self.stopping = True
+        self.wakeup.set()
+
+    def reload(self, *args):
+        logger.info("Reloading the duplicate check service")
+        self.reloading = True
+        self.wakeup.set()
+
+    def installSignalHandlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload)
+
+    ## Read the next expiry from the store, after skips devices that expired already and are left to the next scan
+    def scheduleExpiries(self, after=None):
+        self.next_expiry = self.check.expiry_store.nextExpiry(after)
+        if self.next_expiry is not None:
+            logger.info(f"Next tracked device expires at {time.ctime(self.next_expiry)}")
+
+    ## Delete the devices that have expired by now, failed deletes are retried by the next scan
+    def deleteExpired(self, now):
+        if self.next_expiry is None or self.next_expiry > now:
+            return []
+        due = self.check.expiry_store.expired(now)
+        deleted = self.check.removeExpiredDevices(due) if due else []
+        if deleted:
+            self.check.expiry_store.remove(deleted)
+            if self.check.duplicate_index is not None:
+                self.check.duplicate_index.removeDevices(deleted)
+        self.scheduleExpiries(now)
+        return deleted
+
+    ## Called from the receiver threads
+    def queueEvents(self, events):
+        self.events.extend(events)
+        self.wakeup.set()
+
+    def __fetchDevice(self, device_id):
+        try:
+            return self.check.x.getDevice(device_id)
+        except APICallFailedException as e:
+            logger.warning(f"API to read device {device_id} failed with {e}")
+            return None
+
+    ## Apply the queued events and check the duplicate groups of the devices they changed
+    def processEvents(self):
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        if not events:
+            return None
+        duplicate_index = self.check.duplicate_index
+        if duplicate_index is None:
+            # the next scan collects every device anyway
+            logger.info(f"{len(events)} device events dropped, no scan has collected the devices yet")
+            return None
+        changed = []
+        for event in events:
+            device_id = applyDeviceEvent(duplicate_index, event, self.__fetchDevice)
+            if device_id is not None:
+                changed.append(device_id)
+        logger.info(f"{len(events)} device events changed {len(changed)} devices")
+        if not changed:
+            return None
+        try:
+            summary = self.check.evaluateDevices(changed)
+        except APICallFailedException as e:
+            logger.error(f"Duplicate check of {len(changed)} changed devices failed with {e}, the next scan retries it")
+            return None
+        if summary is not None:
+            logger.info(f"Device events unmanaged {len(summary['unmanaged'])} devices")
+            self.scheduleExpiries()
+        return summary
+
+    def scan(self):
+        try:
+            summary = self.check.run()
+        except APICallFailedException as e:
+            logger.error(f"Duplicate scan failed with {e}, retrying in {self.scan_interval} seconds")
+        else:
+            logger.info(f"Duplicate scan found {summary['devices']} devices, unmanaged {len(summary['unmanaged'])} and deleted {len(summary['deleted'])}")
+        self.scheduleExpiries()
+        self.next_scan = time.time() + self.scan_interval
+
+    def __reload(self):
+        self.reloading = False
+        if self.reload_callback is not None:
+            self.check, self.scan_interval = self.reload_callback(self.check)
+        if self.check.inventory_cache is not None:
+            self.check.inventory_cache.invalidate()
+        # scan straight away with the reloaded settings
+        self.next_scan = 0
+
+    def run(self):
+        logger.info(f"Duplicate check service started, scanning every {self.scan_interval} seconds")
+        if self.receiver is not None:
+            self.receiver.start()
+        try:
+            self.__loop()
+        finally:
+            if self.receiver is not None:
+                self.receiver.stop()
+        logger.info("Duplicate check service stopped")
+
+    def __loop(self):
+        while not self.stopping:
+            if self.reloading:
+                self.__reload()
+            if time.time() >= self.next_scan:
+                # events that arrived before the scan are covered by it
+                self.events.clear()
+                self.scan()
+            if self.stopping:
+                break
+            self.processEvents()
+            self.deleteExpired(time.time())
+            wake_at = self.next_scan
+            if self.next_expiry is not None:
+                wake_at = min(wake_at, self.next_expiry)
+            if not self.events:
+                self.wakeup.wait(max(0, wake_at - time.time()))
+            self.wakeup.clear()
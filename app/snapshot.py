@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import time
+from app.xiq_api import DEVICE_FIELDS
+
+logger = logging.getLogger('Duplicate_Check.snapshot')
+
+SNAPSHOT_VERSION = 1
+
+
+# Inventory snapshot as JSON lines: a header with the field names, one array of field values per device,
+# and a closing line with the CCG and the tracked devices, which are only known once the collection is done.
+# Devices are written as they are collected and read back one line at a time.
+class SnapshotWriter:
+    def __init__(self, path, fields=DEVICE_FIELDS):
+        self.path = path
+        self.fields = tuple(fields)
+        self.count = 0
+        self.created = time.time()
+        self.tmp_path = f"{path}.tmp"
+        self.FH = open(self.tmp_path, "w")
+        self.FH.write(json.dumps({"snapshot": SNAPSHOT_VERSION, "created": self.created, "fields": list(self.fields)}) + "\n")
+
+    ## Pass the devices through, writing each one to the snapshot
+    def record(self, devices):
+        for device in devices:
+            self.FH.write(json.dumps([device.get(field) for field in self.fields]) + "\n")
+            self.count += 1
+            yield device
+
+    def close(self, ccg_group, ccg, tracked, complete=True):
+        self.FH.write(json.dumps({"state": {"ccg_group": ccg_group, "ccg": ccg, "tracked": tracked, "complete": complete}}) + "\n")
+        self.FH.flush()
+        os.fsync(self.FH.fileno())
+        self.FH.close()
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"Snapshot of {self.count} devices written to {self.path}")
+
+    ## Drop an unfinished snapshot
+    def abort(self):
+        self.FH.close()
+        os.remove(self.tmp_path)
+
+
+class SnapshotReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path) as FH:
+            header = json.loads(FH.readline())
+        if header.get('snapshot') != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} inventory snapshot")
+        self.created = header['created']
+        self.fields = tuple(header['fields'])
+        self.state = None
+
+    ## Yield the devices one at a time, the closing state is read once the devices are done
+    def iterDevices(self):
+        fields = self.fields
+        with open(self.path) as FH:
+            FH.readline()
+            for line in FH:
+                if line.startswith('['):
+                    yield dict(zip(fields, json.loads(line)))
+                elif line.strip():
+                    self.state = json.loads(line)['state']
+        if self.state is None:
+            raise ValueError(f"{self.path} is incomplete, the collection did not finish")
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import os
+import json
+
+
+def writeTextAtomic(path, text):
+    writeLinesAtomic(path, [text])
+
+
+## The same for a file written a piece at a time, so a large file is never held as one string
+def writeLinesAtomic(path, lines):
+    # write to a temp file next to the target and swap it in, so a crash never leaves a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as FH:
+        FH.writelines(lines)
+        FH.flush()
+        os.fsync(FH.fileno())
+    os.replace(tmp_path, path)
+
+
+def writeJsonAtomic(path, data):
+    writeTextAtomic(path, json.dumps(data))
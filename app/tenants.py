@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import logging
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from app.xiq_api import XIQ, APICallFailedException
+from app.logger import setLogFile, flushLog
+from app.check import DuplicateCheck
+from app.duplicates import hostnameRules
+from app.inventory_cache import InventoryCache
+from app.storage import writeJsonAtomic
+from app.expiry_store import openExpiryStore
+
+logger = logging.getLogger('Duplicate_Check.tenants')
+
+# settings a tenant can override, the rest of the tenant entry is name and token
+TENANT_SETTINGS = ("ccg_group", "page_concurrency", "batch_size", "batch_concurrency", "full_resync_hours", "expiry_store", "use_inventory_cache", "url",
+                   "report", "prometheus", "duplicate_keys", "hostname_ignore_case", "hostname_strip_patterns")
+
+
+def loadTenants(config_file):
+    with open(config_file) as FH:
+        config = json.load(FH)
+    names = set()
+    for tenant in config.get('tenants', []):
+        if not tenant.get('name') or not tenant.get('token'):
+            raise ValueError(f"every tenant in {config_file} needs a name and a token")
+        if tenant['name'] in names:
+            raise ValueError(f"tenant {tenant['name']} is listed more than once in {config_file}")
+        names.add(tenant['name'])
+    return config
+
+
+## Run the check for one tenant, with its own state directory, log file and output file
+def runTenant(tenant, defaults, state_dir):
+    name = tenant['name']
+    settings = dict(defaults)
+    settings.update({key: tenant[key] for key in TENANT_SETTINGS if key in tenant})
+    tenant_dir = os.path.join(state_dir, name)
+    os.makedirs(tenant_dir, exist_ok=True)
+    setLogFile(os.path.join(tenant_dir, 'Duplicate_AP_log.log'))
+    summary = {"tenant": name, "status": "success"}
+    start = time.time()
+    with open(os.path.join(tenant_dir, 'output.txt'), 'w') as FH, redirect_stdout(FH):
+        expiry_store = openExpiryStore(settings.get('expiry_store') or os.path.join(tenant_dir, 'monitor_unmanaged.db'))
+        inventory_cache = None
+        if settings.get('use_inventory_cache', True):
+            inventory_cache = InventoryCache(os.path.join(tenant_dir, 'inventory_cache.json'),
+                                             full_resync_interval=settings['full_resync_hours']*60*60)
+        try:
+            x = XIQ(token=tenant['token'], pool_size=settings['page_concurrency'] + 1, url=settings['url'])
+            check = DuplicateCheck(x, expiry_store, ccg_group=settings['ccg_group'], inventory_cache=inventory_cache,
+                                   page_concurrency=settings['page_concurrency'], batch_size=settings['batch_size'],
+                                   batch_concurrency=settings['batch_concurrency'],
+                                   report_file=os.path.join(tenant_dir, 'run_report.json') if settings.get('report') else None,
+                                   prometheus_file=os.path.join(tenant_dir, 'run_report.prom') if settings.get('prometheus') else None,
+                                   ccg_cache_file=os.path.join(tenant_dir, 'ccg_cache.json'),
+                                   duplicate_keys=settings.get('duplicate_keys', ("hostname",)),
+                                   hostname_rules=hostnameRules(settings.get('hostname_ignore_case', False), settings.get('hostname_strip_patterns', ())),
+                                   journal_file=os.path.join(tenant_dir, 'run_journal.jsonl'))
+            summary.update(check.run())
+        except APICallFailedException as e:
+            logger.error(f"Tenant {name} failed with {e}")
+            summary["status"] = "failed"
+            summary["error"] = str(e)
+        finally:
+            expiry_store.close()
+    summary["duration"] = round(time.time() - start, 1)
+    # the worker process may exit without running atexit, so the log of the tenant is written out now
+    flushLog()
+    return summary
+
+
+## Run every tenant of the config file in a process pool and write a combined summary
+def runTenants(config_file, defaults, state_dir, max_workers=4):
+    config = loadTenants(config_file)
+    tenants = config.get('tenants', [])
+    state_dir = config.get('state_dir', state_dir)
+    max_workers = config.get('max_workers', max_workers)
+    os.makedirs(state_dir, exist_ok=True)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(tenants)))) as executor:
+        futures = {executor.submit(runTenant, tenant, defaults, state_dir): tenant['name'] for tenant in tenants}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                logger.error(f"Tenant {name} failed with {e}")
+                summary = {"tenant": name, "status": "failed", "error": str(e)}
+            print(f"{name}: {summary['status']}")
+            summaries.append(summary)
+    summaries.sort(key=lambda summary: summary['tenant'])
+    writeJsonAtomic(os.path.join(state_dir, 'tenants_summary.json'), summaries)
+    failed = [summary['tenant'] for summary in summaries if summary['status'] != 'success']
+    log_msg = f"Checked {len(summaries)} tenants, {len(failed)} failed"
+    if failed:
+        log_msg += f": {', '.join(failed)}"
+    logger.info(log_msg)
+    print(log_msg)
+    return summaries
@@ -5,20 +5,44 @@ import inspect
 import sys
 import json
 import time
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Queue, Empty
 from pprint import pprint as pp
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir) 
-from requests.exceptions import HTTPError, ReadTimeout
-from app.logger import logger
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, ReadTimeout, RequestException
+from app.logger import logger, summarizeIds, idFields, Progress
+from app.batch import BatchExecutor
+from app.metrics import Metrics, endpointName
+from app.rate_control import sharedController
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+try:
+    # orjson is optional, it decodes the large device pages noticeably faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logger = logging.getLogger('PSK_Rotator.xiq_api')
 
 PATH = current_dir
 
+# fields needed by the duplicate check, used by iterDevices unless others are asked for
+DEVICE_FIELDS = ("id", "hostname", "serial_number", "mac_address", "connected", "device_admin_state")
+
+# a 5xx or a lost connection is only retried for methods that are safe to send twice, a 429 always is
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+RETRY_METHODS = ("GET", "PUT", "DELETE")
+
+# rounds of device reads that follow up ids XIQ accepted with a 202, before they are left to a later run
+ACCEPTED_CHECKS = 5
+
 class APICallFailedException(Exception):
     def __init__(self, message):
         self.message = message
@@ -26,14 +50,23 @@ class APICallFailedException(Exception):
 
 
 class XIQ:
-    def __init__(self, user_name=None, password=None, token=None):
-        self.URL = "https://api.extremecloudiq.com"
-        self.headers = {"Accept": "application/json", "Content-Type": "application/json"}
+    def __init__(self, user_name=None, password=None, token=None, pool_size=10, url="https://api.extremecloudiq.com", metrics=None, controller=None):
+        self.URL = url
+        self.headers = {"Accept": "application/json", "Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"}
         self.proxyDict = {
             "http": "",
             "https": ""
         }
         self.totalretries = 5
+        # one pooled keep-alive session is shared by every call, so the TLS handshake is paid once per run
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # per endpoint latency, bytes, status codes and retries of every call
+        self.metrics = metrics if metrics is not None else Metrics()
+        # paces the calls of this account, shared with every other XIQ client of the account in this process
+        self.controller = controller if controller is not None else sharedController(url, token or user_name, max_concurrency=pool_size)
         if token:
             self.headers["Authorization"] = "Bearer " + token
         else:
@@ -51,133 +84,83 @@ class XIQ:
                 print(log_msg)
                 raise SystemExit 
     #API CALLS
-    def __get_api_call(self, url):
-        try:
-            response = requests.get(url, headers= self.headers, verify=False, proxies=self.proxyDict)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise APICallFailedException(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if response.status_code != 200:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            logger.error(f"{log_msg}")
+    ## missing_ok returns None for a 404 instead of raising, for reads that expect the object to be gone
+    def __api_call(self, method, url, payload=None, missing_ok=False):
+        endpoint = endpointName(method, url)
+        bytes_sent = len(payload) if payload else 0
+        attempt = 1
+        while True:
+            self.controller.acquire()
+            start = time.perf_counter()
             try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.warning(f"\t\t{response.text}")
-            else:
-                if 'error_message' in data:
-                    logger.warning(f"\t\t{data['error_message']}")
-                else:
-                    logger.warning(f"\n\n{data}")
-            raise APICallFailedException(log_msg) 
-        try:
-            data = response.json()
-        except json.JSONDecodeError:
-            logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
-            raise APICallFailedException("Unable to parse the data from json, script cannot proceed")
-        return data
-    
-    def __put_api_call(self, url, payload):
-        try:
-            response = requests.put(url, headers= self.headers, data=payload, verify=False, proxies=self.proxyDict)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise APICallFailedException(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if response.status_code != 200:
+                response = self.session.request(method, url, headers=self.headers, data=payload, verify=False, proxies=self.proxyDict)
+            except RequestException as http_err:
+                latency = time.perf_counter() - start
+                self.controller.release(None, latency)
+                self.metrics.recordCall(endpoint, "error", latency, bytes_sent)
+                if method in RETRY_METHODS and attempt < self.totalretries:
+                    self.__wait_retry(endpoint, attempt, http_err)
+                    attempt += 1
+                    continue
+                logger.error(f'HTTP error occurred: {http_err} - on API {url}')
+                raise APICallFailedException(f'HTTP error occurred: {http_err}') 
+            latency = time.perf_counter() - start
+            self.controller.release(response.status_code, latency, response.headers)
+            self.metrics.recordCall(endpoint, response.status_code, latency, bytes_sent, len(response.content))
+            retryable = response.status_code == 429 or (response.status_code in RETRY_STATUS_CODES and method in RETRY_METHODS)
+            if not retryable or attempt >= self.totalretries:
+                break
+            self.__wait_retry(endpoint, attempt, f"HTTP Status Code: {response.status_code}", response.headers)
+            attempt += 1
+        if missing_ok and response.status_code == 404:
+            return None
+        # GET and PUT only accept a 200, POST and DELETE also accept 201 and a 202 acknowledgement
+        accepts_created = method in ("POST", "DELETE")
+        if accepts_created and response.status_code == 202:
+            return response.status_code
+        elif response.status_code != 200 and not (accepts_created and response.status_code == 201):
             log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
             logger.error(f"{log_msg}")
             try:
-                data = response.json()
-            except json.JSONDecodeError:
+                data = json_loads(response.content)
+            except ValueError:
                 logger.warning(f"\t\t{response.text}")
             else:
-                if 'error_message' in data:
+                if isinstance(data, dict) and 'error_message' in data:
                     logger.warning(f"\t\t{data['error_message']}")
+                    if accepts_created:
+                        raise APICallFailedException(data['error_message'])
                 else:
                     logger.warning(f"{data}")
-            raise APICallFailedException(log_msg) 
+            raise APICallFailedException(log_msg)
+        if accepts_created and not response.content:
+            return response.status_code
+        decode_start = time.perf_counter()
         try:
-            data = response.json()
-        except json.JSONDecodeError:
+            data = json_loads(response.content)
+        except ValueError:
             logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
             raise APICallFailedException("Unable to parse the data from json, script cannot proceed")
+        self.metrics.recordDecode(endpoint, time.perf_counter() - decode_start)
         return data
 
+    def __wait_retry(self, endpoint, attempt, error, headers=None):
+        delay = self.controller.backoff(attempt, headers)
+        logger.warning(f"{endpoint} failed with {error}, retrying in {delay:.1f} seconds ({attempt} of {self.totalretries - 1})")
+        self.metrics.recordRetry(endpoint)
+        time.sleep(delay)
+
+    def __get_api_call(self, url):
+        return self.__api_call("GET", url)
+    
+    def __put_api_call(self, url, payload):
+        return self.__api_call("PUT", url, payload)
+
     def __post_api_call(self, url, payload):
-        try:
-            response = requests.post(url, headers= self.headers, data=payload, verify=False, proxies=self.proxyDict)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise ValueError(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if response.status_code == 202:
-            return response.status_code
-        elif response.status_code != 200 and response.status_code != 201:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            logger.error(f"{log_msg}")
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.warning(f"\t\t{response.text}")
-            else:
-                if 'error_message' in data:
-                    logger.warning(f"\t\t{data['error_message']}")
-                    raise APICallFailedException(data['error_message'])
-            raise APICallFailedException(log_msg)
-        if response.text:
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
-                raise APICallFailedException("Unable to parse the data from json, script cannot proceed")
-            return data
-        else:
-            return response.status_code
+        return self.__api_call("POST", url, payload)
         
     def __delete_api_call(self, url):
-        try:
-            response = requests.delete(url, headers= self.headers, verify=False, proxies=self.proxyDict)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise ValueError(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if response.status_code == 202:
-            return response.status_code
-        elif response.status_code != 200 and response.status_code != 201:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            logger.error(f"{log_msg}")
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.warning(f"\t\t{response.text}")
-            else:
-                if 'error_message' in data:
-                    logger.warning(f"\t\t{data['error_message']}")
-                    raise APICallFailedException(data['error_message'])
-            raise APICallFailedException(log_msg)
-        if response.text:
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
-                raise APICallFailedException("Unable to parse the data from json, script cannot proceed")
-            return data
-        else:
-            return response.status_code
+        return self.__api_call("DELETE", url)
       
     def __getAccessToken(self, user_name, password):
         info = "get XIQ token"
@@ -213,27 +196,161 @@ class XIQ:
     
     # Devices
     ## Check for config mismatches
-    def collectDevices(self, pageSize=100, location_id=None):
+    def collectDevices(self, pageSize=None, location_id=None, concurrency=1, cache=None):
         info = "to collect devices" 
-        page = 1
-        pageCount = 1
-        firstCall = True
+        pageSize = pageSize or self.controller.pageSize()
+        if cache is not None:
+            # the cache holds the projected fields it was created with and is refreshed incrementally,
+            # the devices are yielded as they arrive
+            return cache.refresh(self, pageSize=pageSize, concurrency=concurrency)
+        url = f"{self.URL}/devices?views=FULL&limit={str(pageSize)}"
+        if location_id:
+            url = url  + "&locationId=" +str(location_id)
         devices = []
-        while page <= pageCount:
-            url = f"{self.URL}/devices?views=FULL&page={str(page)}&limit={str(pageSize)}"
-            if location_id:
-                url = url  + "&locationId=" +str(location_id)
+        for data in self.__iter_device_pages(url, concurrency):
+            devices.extend(data)
+        return devices
+
+    ## Stream devices page by page with only the requested fields
+    def iterDevices(self, pageSize=None, location_id=None, fields=DEVICE_FIELDS, concurrency=1, connected=None):
+        pageSize = pageSize or self.controller.pageSize()
+        url = f"{self.URL}/devices?views=BASIC&limit={str(pageSize)}&fields={','.join(field.upper() for field in fields)}"
+        if location_id:
+            url = url  + "&locationId=" +str(location_id)
+        if connected is not None:
+            url = url + "&connected=" + str(connected).lower()
+        for data in self.__iter_device_pages(url, concurrency):
+            for device in data:
+                yield {field: device.get(field) for field in fields}
+
+    ## Number of devices in XIQ, only a single one-device page is requested
+    def countDevices(self, location_id=None, connected=None):
+        url = f"{self.URL}/devices?views=BASIC&fields=ID&limit=1&page=1"
+        if location_id:
+            url = url  + "&locationId=" +str(location_id)
+        if connected is not None:
+            url = url + "&connected=" + str(connected).lower()
+        try:
+            rawList = self.__get_api_call(url)
+        except APICallFailedException as e:
+            raise APICallFailedException(e)
+        return rawList['total_count']
+
+    ## One device with only the requested fields
+    def getDevice(self, device_id, fields=DEVICE_FIELDS):
+        url = f"{self.URL}/devices/{device_id}?views=BASIC"
+        try:
+            device = self.__get_api_call(url)
+        except APICallFailedException as e:
+            raise APICallFailedException(e)
+        return {field: device.get(field) for field in fields}
+
+    ## Ids of the most recently onboarded devices, from one page sorted by id, newest first
+    def newestDeviceIds(self, count=10):
+        url = f"{self.URL}/devices?views=BASIC&fields=ID&limit={count}&page=1&sortField=ID&sortOrder=DESC"
+        try:
+            rawList = self.__get_api_call(url)
+        except APICallFailedException as e:
+            raise APICallFailedException(e)
+        return [device['id'] for device in rawList['data']]
+
+    ## Stream the devices of several locations in parallel, devices found in more than one location are yielded once
+    def iterShardedDevices(self, location_ids, shard_concurrency=4, pageSize=None, fields=DEVICE_FIELDS):
+        pageSize = pageSize or self.controller.pageSize()
+        pages = Queue(maxsize=shard_concurrency * 2)
+        done = object()
+        stop = threading.Event()
+        def collectShard(location_id):
             try:
-                rawList = self.__get_api_call(url)
+                batch = []
+                for device in self.iterDevices(pageSize=pageSize, location_id=location_id, fields=fields):
+                    if stop.is_set():
+                        return
+                    batch.append(device)
+                    if len(batch) >= pageSize:
+                        pages.put(batch)
+                        batch = []
+                if batch:
+                    pages.put(batch)
             except APICallFailedException as e:
-                raise APICallFailedException(e)
-            devices = devices + rawList['data']
+                pages.put(e)
+            finally:
+                pages.put(done)
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=max(1, shard_concurrency))
+        futures = []
+        try:
+            for location_id in location_ids:
+                futures.append(executor.submit(collectShard, location_id))
+            remaining = len(location_ids)
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, APICallFailedException):
+                    raise APICallFailedException(item)
+                else:
+                    for device in item:
+                        if device['id'] not in seen:
+                            seen.add(device['id'])
+                            yield device
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            # drain so no running shard stays blocked on a full queue
+            while not all(future.done() for future in futures):
+                try:
+                    pages.get(timeout=0.1)
+                except Empty:
+                    pass
 
-            if firstCall == True:
-                pageCount = rawList['total_pages']
-            print(f"completed page {page} of {rawList['total_pages']} collecting Devices")
-            page = rawList['page'] + 1 
-        return devices
+    def __iter_device_pages(self, url, concurrency=1):
+        # first page is always fetched on its own to learn total_pages
+        rawList = self.__get_page(url, 1)
+        pageCount = rawList['total_pages']
+        progress = Progress(pageCount, "collecting Devices")
+        progress.update(1)
+        yield rawList['data']
+        if pageCount <= 1:
+            return
+        if concurrency <= 1:
+            for page in range(2, pageCount + 1):
+                rawList = self.__get_page(url, page)
+                progress.update(page)
+                yield rawList['data']
+            return
+        # remaining pages are pulled through a bounded pool and yielded in page order. Only a
+        # window of pages is in flight, so memory stays bounded by page size and not fleet size
+        pages = iter(range(2, pageCount + 1))
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        in_flight = deque()
+        try:
+            for page in islice(pages, concurrency * 2):
+                in_flight.append((page, executor.submit(self.__get_page, url, page)))
+            while in_flight:
+                page, future = in_flight.popleft()
+                try:
+                    rawList = future.result()
+                except APICallFailedException as e:
+                    raise APICallFailedException(e)
+                next_page = next(pages, None)
+                if next_page is not None:
+                    in_flight.append((next_page, executor.submit(self.__get_page, url, next_page)))
+                progress.update(page)
+                yield rawList['data']
+        finally:
+            for page, future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def __get_page(self, url, page):
+        # __api_call already retried the page on a 429, a 5xx or a lost connection, anything
+        # that still fails here is not going to succeed by asking again
+        try:
+            return self.__get_api_call(f"{url}&page={str(page)}")
+        except APICallFailedException as e:
+            logger.error(f"page {page} failed: {e}")
+            raise APICallFailedException(e)
 
     ##Unmanage devices
     def unmanageDevices(self,device_ids:list):
@@ -245,7 +362,7 @@ class XIQ:
             response = self.__post_api_call(url,payload)
         except APICallFailedException as e:
                 raise APICallFailedException(e)
-        logger.info(f"Successfully unmanaged devices: {', '.join(map(str, device_ids))}")
+        logger.info(f"Successfully unmanaged devices: {summarizeIds(device_ids)}", extra=idFields(device_ids))
         return "Success"    
     
     def deleteDevices(self,device_ids:list):
@@ -257,17 +374,81 @@ class XIQ:
             response = self.__post_api_call(url,payload)
         except APICallFailedException as e:
                 raise APICallFailedException(e)
-        logger.info(f"Successfully deleted devices: {', '.join(map(str, device_ids))}")
+        logger.info(f"Successfully deleted devices: {summarizeIds(device_ids)}", extra=idFields(device_ids))
         return "Success" 
     
+    ## Unmanage or delete devices in chunks with bounded parallelism, returns a BatchResult
+    def bulkUnmanageDevices(self, device_ids, chunk_size=100, max_workers=4, on_chunk=None):
+        return self.__bulk_device_action("unmanage", device_ids, chunk_size, max_workers, on_chunk)
+
+    def bulkDeleteDevices(self, device_ids, chunk_size=100, max_workers=4, on_chunk=None):
+        return self.__bulk_device_action("delete", device_ids, chunk_size, max_workers, on_chunk)
+
+    def __bulk_device_action(self, action, device_ids, chunk_size, max_workers, on_chunk=None):
+        url = f"{self.URL}/devices/:{action}"
+        def call(chunk):
+            response = self.__post_api_call(url, json.dumps({"ids": chunk}))
+            # a 202 only acknowledges the request, XIQ finishes it asynchronously
+            return response if response == 202 else 200
+        result = BatchExecutor(chunk_size, max_workers).run(call, device_ids, on_chunk)
+        if result.accepted:
+            self.__confirm_accepted(action, result, max_workers)
+        logger.info(f"Bulk {action} of {len(device_ids)} devices: {result.summary()}")
+        if result.succeeded:
+            logger.info(f"Successfully {action}d devices: {summarizeIds(result.succeeded)}", extra=idFields(result.succeeded))
+        if result.failed:
+            logger.error(f"Failed to {action} devices: {summarizeIds(result.failed)}", extra=idFields(result.failed))
+        return result
+
+    ## Read the devices XIQ only accepted until they show the change, the ones that do are moved to succeeded.
+    ## The rest stay in accepted, so they are not treated as changed
+    def __confirm_accepted(self, action, result, max_workers):
+        def changed(device_id):
+            try:
+                device = self.__api_call("GET", f"{self.URL}/devices/{device_id}?views=BASIC", missing_ok=True)
+            except APICallFailedException:
+                return False
+            if action == "delete":
+                return device is None
+            return device is not None and device.get('device_admin_state') == "UNMANAGED"
+        pending = result.accepted
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for attempt in range(1, ACCEPTED_CHECKS + 1):
+                time.sleep(self.controller.backoff(attempt))
+                done = list(executor.map(changed, pending))
+                result.succeeded.extend(device_id for device_id, ok in zip(pending, done) if ok)
+                pending = [device_id for device_id, ok in zip(pending, done) if not ok]
+                if not pending:
+                    break
+        logger.info(f"{len(result.accepted) - len(pending)} of {len(result.accepted)} devices XIQ accepted to {action} show the change")
+        result.accepted = pending
+
+    # Locations
+    def getLocationTree(self):
+        url = f"{self.URL}/locations/tree"
+        try:
+            return self.__get_api_call(url)
+        except APICallFailedException as e:
+            raise APICallFailedException(e)
+
     # CCG
-    ## Check if CCG group exists
-    def checkForCCG(self,ccg_name,pageSize=100):
+    ## Check if CCG group exists, a known ccg_id is revalidated with one direct GET before paging through every CCG
+    def checkForCCG(self,ccg_name,pageSize=None,ccg_id=None):
         info = "collecting CCGs"
+        pageSize = pageSize or self.controller.pageSize()
+        if ccg_id is not None:
+            try:
+                ccg = self.getCCG(ccg_id)
+            except APICallFailedException as e:
+                logger.info(f"cached ccg {ccg_id} could not be read ({e}), searching all CCGs")
+            else:
+                if ccg.get("name") == ccg_name:
+                    return True, ccg
+                logger.info(f"cached ccg {ccg_id} is no longer named {ccg_name}, searching all CCGs")
         page = 1
         pageCount = 1
         firstCall = True
-        ccgs = []
+        progress = None
         while page <= pageCount:
             url = f"{self.URL}/ccgs?page={str(page)}&limit={str(pageSize)}"
             try:
@@ -277,15 +458,23 @@ class XIQ:
             ccg_match = next((d for d in rawList['data'] if d.get("name") == ccg_name), None)
             if ccg_match:
                 return True, ccg_match
-            ccgs = ccgs + rawList['data']
             if firstCall == True:
                 pageCount = rawList['total_pages']
             # check for ccg_name
             
-            print(f"completed page {page} of {rawList['total_pages']} collecting CCGs")
+            if progress is None:
+                progress = Progress(rawList['total_pages'], "collecting CCGs")
+            progress.update(page)
             page = rawList['page'] + 1 
         return False, {}
     
+    def getCCG(self, ccg_id):
+        url = f"{self.URL}/ccgs/{ccg_id}"
+        try:
+            return self.__get_api_call(url)
+        except APICallFailedException as e:
+            raise APICallFailedException(e)
+
     ## Create CCG group
     def createCCG(self, data):
         url = f"{self.URL}/ccgs"
@@ -293,7 +482,7 @@ class XIQ:
             response = self.__post_api_call(url,payload=json.dumps(data))
         except APICallFailedException as e:
             raise APICallFailedException(e)
-        logger.info(f"Successfully created ccg: {data['name']} with devices: {', '.join(map(str, data['device_ids']))}")
+        logger.info(f"Successfully created ccg: {data['name']} with devices: {summarizeIds(data['device_ids'])}", extra=idFields(data['device_ids']))
         return response['id']
 
     # Update CCG group
@@ -304,7 +493,7 @@ class XIQ:
             response = self.__put_api_call(url,payload=payload)
         except APICallFailedException as e:
             raise APICallFailedException(e)
-        logger.info(f"Successfully added devices to ccg: {', '.join(map(str, device_ids))}")
+        logger.info(f"Successfully added devices to ccg: {summarizeIds(device_ids)}", extra=idFields(device_ids))
         return response['id']
     
     def deleteCCG(self, ccg_id):
@@ -315,3 +504,18 @@ class XIQ:
             raise APICallFailedException(e)
         logger.info(f"Successfully deleted ccg")
         return "Success"
+
+    ## Add and remove CCG members. The API only replaces the whole member list, so the new list is built
+    ## locally and sent only when it differs. Returns the new member list, or None when nothing changed
+    def updateCCGMembership(self, ccg_id, current_ids, add=(), remove=()):
+        remove = set(remove)
+        current = set(current_ids)
+        to_add = [device_id for device_id in dict.fromkeys(add) if device_id not in current]
+        to_remove = [device_id for device_id in current_ids if device_id in remove]
+        if not to_add and not to_remove:
+            logger.info(f"ccg {ccg_id} membership is unchanged, no update sent")
+            return None
+        device_ids = [device_id for device_id in current_ids if device_id not in remove] + to_add
+        self.updateCCG(ccg_id, device_ids)
+        logger.info(f"ccg {ccg_id} membership updated, {len(to_add)} added and {len(to_remove)} removed")
+        return device_ids
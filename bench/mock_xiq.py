@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+DEVICE_FIELD_NAMES = ("id", "hostname", "serial_number", "mac_address", "connected", "device_admin_state", "location_id")
+
+
+## Synthetic fleet, duplicate_ratio of the hostnames belong to a replaced AP that is still managed and offline
+def generateFleet(device_count, duplicate_ratio=0.01, buildings=10, seed=1):
+    rng = random.Random(seed)
+    replaced = int(device_count * duplicate_ratio)
+    devices = []
+    for i in range(device_count - replaced):
+        devices.append({
+            "id": 100000 + i,
+            "hostname": f"AP-{i:07d}",
+            "serial_number": f"SN{i:010d}",
+            "mac_address": f"{i:012X}",
+            "connected": rng.random() > 0.05,
+            "device_admin_state": "MANAGED",
+            "location_id": 1000 + i % buildings
+        })
+    # the replaced APs share a hostname with a live AP and were never unmanaged
+    for n, original in enumerate(rng.sample(devices, replaced)):
+        devices.append(dict(original, id=100000 + device_count + n, serial_number=f"SR{n:010d}",
+                            mac_address=f"R{n:011X}", connected=False))
+    return devices
+
+
+# In memory stand-in for the XIQ endpoints used by the script
+class MockXIQ:
+    def __init__(self, devices, latency=0.0, error_rate_429=0.0, error_rate_5xx=0.0, buildings=10, seed=1, rate_limit=0, rate_window=60.0, async_delay=None):
+        self.devices = {device['id']: device for device in devices}
+        # filtered device lists are kept between page requests and dropped when a device changes
+        self.views = {}
+        self.ccgs = {}
+        self.latency = latency
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.buildings = buildings
+        self.requests = Counter()
+        self.status_codes = Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        # with a rate limit every response carries RateLimit headers and calls over the limit get a 429
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.window_start = time.time()
+        self.window_calls = 0
+        # with an async delay, unmanage and delete are answered with a 202 and only done that many seconds later
+        self.async_delay = async_delay
+        self.server = None
+
+    ## RateLimit headers for this call, and the seconds to wait when the limit is used up
+    def takeRateLimit(self):
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_calls = 0
+            self.window_calls += 1
+            reset = max(1, int(self.window_start + self.rate_window - now + 0.999))
+            remaining = max(0, self.rate_limit - self.window_calls)
+            headers = {"RateLimit-Limit": str(self.rate_limit), "RateLimit-Remaining": str(remaining), "RateLimit-Reset": str(reset)}
+            return headers, reset if self.window_calls > self.rate_limit else None
+
+    def locationTree(self):
+        return [{"id": 1, "name": "Global", "type": "GLOBAL", "children": [
+            {"id": 10, "name": "Site", "type": "SITE", "children": [
+                {"id": 1000 + b, "name": f"Building {b}", "type": "BUILDING", "children": []} for b in range(self.buildings)]}]}]
+
+    def listDevices(self, query):
+        page = int(query.get('page', 1))
+        limit = int(query.get('limit', 10))
+        fields = [field.lower() for field in query['fields'].split(',')] if query.get('fields') else DEVICE_FIELD_NAMES
+        key = (query.get('connected'), query.get('locationId'), query.get('sortField'), query.get('sortOrder'))
+        with self.lock:
+            devices = self.views.get(key)
+            if devices is None:
+                devices = list(self.devices.values())
+                if key[0] is not None:
+                    devices = [device for device in devices if device['connected'] == (key[0] == 'true')]
+                if key[1] is not None:
+                    devices = [device for device in devices if device['location_id'] == int(key[1])]
+                if key[2] == 'ID':
+                    devices = sorted(devices, key=lambda device: device['id'], reverse=key[3] == 'DESC')
+                self.views[key] = devices
+        total_pages = max(1, -(-len(devices) // limit))
+        data = [{field: device.get(field) for field in fields} for device in devices[(page - 1) * limit:page * limit]]
+        return {"page": page, "count": len(data), "total_pages": total_pages, "total_count": len(devices), "data": data}
+
+    ## Make the changes of replayed device events, so the next full collection agrees with them
+    def applyEvents(self, events):
+        with self.lock:
+            self.views.clear()
+            for event in events:
+                data = dict(event, **event.get('data', {}))
+                device_id = int(data.get('device_id', data.get('id')))
+                event_type = event.get('event_type', '').upper()
+                device = self.devices.get(device_id)
+                if device is None:
+                    if event_type != "DEVICE_ONBOARDED":
+                        continue
+                    device = self.devices[device_id] = {"id": device_id, "device_admin_state": "MANAGED", "location_id": 1000}
+                device.update({field: data[field] for field in DEVICE_FIELD_NAMES if field in data and field != "id"})
+                if event_type == "DEVICE_CONNECTED":
+                    device['connected'] = True
+                elif event_type == "DEVICE_DISCONNECTED":
+                    device['connected'] = False
+        return len(events)
+
+    def changeDevices(self, path, device_ids):
+        with self.lock:
+            self.views.clear()
+            for device_id in device_ids:
+                if path == "/devices/:unmanage":
+                    self.devices[device_id]['device_admin_state'] = "UNMANAGED"
+                else:
+                    self.devices.pop(device_id, None)
+
+    def handle(self, method, path, query, body):
+        if method == "GET" and path == "/devices":
+            return 200, self.listDevices(query)
+        if method == "GET" and path.startswith("/devices/") and path[9:].isdigit():
+            device = self.devices.get(int(path[9:]))
+            if device is None:
+                return 404, {"error_message": f"device {path[9:]} not found"}
+            return 200, device
+        if method == "POST" and path == "/mock/events":
+            return 200, {"applied": self.applyEvents(body if isinstance(body, list) else [body])}
+        if method == "GET" and path == "/locations/tree":
+            return 200, self.locationTree()
+        if method == "POST" and path in ("/devices/:unmanage", "/devices/:delete"):
+            with self.lock:
+                for device_id in body['ids']:
+                    if device_id not in self.devices:
+                        return 400, {"error_message": f"device {device_id} not found"}
+            if self.async_delay is not None:
+                threading.Timer(self.async_delay, self.changeDevices, (path, body['ids'])).start()
+                return 202, None
+            self.changeDevices(path, body['ids'])
+            return 200, None
+        if path == "/ccgs" and method == "GET":
+            ccgs = list(self.ccgs.values())
+            return 200, {"page": 1, "count": len(ccgs), "total_pages": 1, "total_count": len(ccgs), "data": ccgs}
+        if path == "/ccgs" and method == "POST":
+            with self.lock:
+                ccg = dict(body, id=500000 + len(self.ccgs))
+                self.ccgs[ccg['id']] = ccg
+            return 201, ccg
+        if path.startswith("/ccgs/"):
+            ccg_id = int(path.split("/")[2])
+            if ccg_id not in self.ccgs:
+                return 404, {"error_message": f"ccg {ccg_id} not found"}
+            if method == "GET":
+                return 200, self.ccgs[ccg_id]
+            if method == "PUT":
+                self.ccgs[ccg_id].update(body)
+                return 200, self.ccgs[ccg_id]
+            if method == "DELETE":
+                del self.ccgs[ccg_id]
+                return 200, None
+        return 404, {"error_message": f"{method} {path} is not mocked"}
+
+    def start(self, port=0):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as separate writes, without this every response waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                endpoint = f"{method} {url.path}"
+                if url.path.startswith("/ccgs/"):
+                    endpoint = f"{method} /ccgs/:id"
+                elif url.path[9:].isdigit():
+                    endpoint = f"{method} /devices/:id"
+                if mock.latency:
+                    time.sleep(mock.latency)
+                rate_headers, limited_for = mock.takeRateLimit() if mock.rate_limit else ({}, None)
+                roll = mock.rng.random()
+                if limited_for is not None:
+                    status, data = 429, {"error_message": "Rate limit exceeded"}
+                    rate_headers["Retry-After"] = str(limited_for)
+                elif roll < mock.error_rate_429:
+                    status, data = 429, {"error_message": "Too Many Requests"}
+                elif roll < mock.error_rate_429 + mock.error_rate_5xx:
+                    status, data = 503, {"error_message": "Service Unavailable"}
+                else:
+                    status, data = mock.handle(method, url.path, dict(parse_qsl(url.query)), body)
+                payload = json.dumps(data).encode() if data is not None else b""
+                with mock.lock:
+                    mock.requests[endpoint] += 1
+                    mock.status_codes[status] += 1
+                    mock.bytes_sent += len(payload)
+                self.send_response(status)
+                if status == 429 and "Retry-After" not in rate_headers:
+                    self.send_header("Retry-After", "1")
+                for name, value in rate_headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def do_PUT(self):
+                self.respond("PUT")
+
+            def do_DELETE(self):
+                self.respond("DELETE")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the XIQ API endpoints used by XIQ_Duplicate_AP_Check.py")
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--buildings', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--error-rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate-5xx', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0, help="calls allowed per rate window, 0 for no limit")
+    parser.add_argument('--rate-window', type=float, default=60.0, help="seconds in a rate window")
+    parser.add_argument('--async-delay', type=float, help="answer unmanage and delete with a 202 and make the change this many seconds later")
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    mock = MockXIQ(generateFleet(args.devices, args.duplicate_ratio, args.buildings), latency=args.latency,
+                   error_rate_429=args.error_rate_429, error_rate_5xx=args.error_rate_5xx, buildings=args.buildings,
+                   rate_limit=args.rate_limit, rate_window=args.rate_window, async_delay=args.async_delay)
+    url = mock.start(args.port)
+    print(f"Mock XIQ with {args.devices} devices listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import random
+import time
+import requests
+from mock_xiq import generateFleet
+
+
+## Events of a JSON lines file, one event per line. An optional "delay" is the seconds to wait before the event is sent
+def loadEvents(path):
+    events = []
+    with open(path) as FH:
+        for line in FH:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def saveEvents(path, events):
+    with open(path, "w") as FH:
+        for event in events:
+            FH.write(json.dumps(event) + "\n")
+
+
+## APs swapped out in the field: a new AP with the hostname of a connected AP is onboarded and comes online,
+## then the old one disconnects. Every swap leaves one offline managed duplicate for the check to find
+def replacementEvents(devices, count, seed=1, first_id=900000, delay=0.0):
+    rng = random.Random(seed)
+    connected = [device for device in devices if device['connected'] and device['device_admin_state'] == "MANAGED"]
+    events = []
+    for n, original in enumerate(rng.sample(connected, min(count, len(connected)))):
+        new_id = first_id + n
+        events.append({"event_type": "DEVICE_ONBOARDED", "delay": delay, "data": {
+            "device_id": new_id, "hostname": original['hostname'], "serial_number": f"SW{n:010d}",
+            "mac_address": f"W{n:011X}"}})
+        events.append({"event_type": "DEVICE_CONNECTED", "data": {"device_id": new_id}})
+        events.append({"event_type": "DEVICE_DISCONNECTED", "data": {"device_id": original['id']}})
+    return events
+
+
+## Post the events to a receiver in batches, mock_url also applies them to a mock XIQ first so its devices match.
+## speed scales the delays, 0 sends everything at once
+def replayEvents(url, events, secret=None, batch_size=1, speed=1.0, mock_url=None):
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {secret}"} if secret else {}
+    sent = 0
+    accepted = 0
+    start = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        batch = [dict(event) for event in events[i:i + batch_size]]
+        delay = sum(event.pop('delay', 0) or 0 for event in batch)
+        if delay and speed:
+            time.sleep(delay / speed)
+        if mock_url:
+            session.post(f"{mock_url}/mock/events", json=batch).raise_for_status()
+        response = session.post(url, json=batch if batch_size > 1 else batch[0], headers=headers)
+        response.raise_for_status()
+        sent += len(batch)
+        accepted += response.json().get('accepted', 0)
+    return {"sent": sent, "accepted": accepted, "seconds": round(time.perf_counter() - start, 3)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay XIQ device events to the webhook receiver of XIQ_Duplicate_AP_Check.py --daemon")
+    parser.add_argument('--url', default="http://127.0.0.1:8443/xiq/events", help="address of the receiver")
+    parser.add_argument('--events', metavar='FILE', help="JSON lines file of events to replay")
+    parser.add_argument('--replacements', type=int, default=0, help="generate this many AP swaps for the fleet of mock_xiq.py instead")
+    parser.add_argument('--devices', type=int, default=10000, help="fleet size the mock was started with")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--buildings', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds between generated swaps")
+    parser.add_argument('--save', metavar='FILE', help="write the generated events to this file instead of sending them")
+    parser.add_argument('--mock-url', help="also apply the events to the mock XIQ at this address")
+    parser.add_argument('--secret', help="webhook secret of the receiver")
+    parser.add_argument('--batch-size', type=int, default=1, help="events sent in each request")
+    parser.add_argument('--speed', type=float, default=1.0, help="delay multiplier, 0 sends every event at once")
+    args = parser.parse_args()
+    if args.events:
+        events = loadEvents(args.events)
+    else:
+        events = replacementEvents(generateFleet(args.devices, args.duplicate_ratio, args.buildings), args.replacements, delay=args.delay)
+    if args.save:
+        saveEvents(args.save, events)
+        print(f"Saved {len(events)} events to {args.save}")
+    else:
+        print(json.dumps(replayEvents(args.url, events, args.secret, args.batch_size, args.speed, args.mock_url)))
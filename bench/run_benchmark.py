@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from mock_xiq import MockXIQ, generateFleet
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a child process so wall time and peak RSS belong to the client alone.
+# The last line printed is the JSON result, everything before it is the script output.
+CHILD = r"""
+import json, os, resource, sys, time
+repo_dir, scenario, url, state_dir, page_concurrency = sys.argv[1:6]
+sys.path.insert(0, repo_dir)
+# the log of a benchmark run stays with its other state and out of the log of the real runs
+from app.logger import setLogFile
+setLogFile(os.path.join(state_dir, "Duplicate_AP_log.log"))
+start = time.perf_counter()
+error = None
+if scenario == "script":
+    import XIQ_Duplicate_AP_Check as script
+    script.token = "benchmark"
+    script.xiq_url = url
+    script.page_concurrency = int(page_concurrency)
+    script.inventory_cache_file = ""
+    script.expiry_store_file = os.path.join(state_dir, "monitor_unmanaged.db")
+    script.unmanaged_file = os.path.join(state_dir, "monitor_unmanaged.json")
+    script.ccg_cache_file = os.path.join(state_dir, "ccg_cache.json")
+    script.journal_file = os.path.join(state_dir, "run_journal.jsonl")
+    script.report_file = os.path.join(state_dir, "run_report.json")
+    try:
+        script.checkDuplicates()
+    except SystemExit as e:
+        error = "script exited"
+else:
+    from app.xiq_api import XIQ
+    x = XIQ(token="benchmark", url=url, pool_size=int(page_concurrency))
+    devices = sum(1 for device in x.iterDevices(concurrency=int(page_concurrency)))
+wall_time = time.perf_counter() - start
+# ru_maxrss survives the exec from the benchmark process, VmHWM belongs to this process only
+try:
+    with open("/proc/self/status") as FH:
+        peak_rss_kb = next(int(line.split()[1]) for line in FH if line.startswith("VmHWM:"))
+except (OSError, StopIteration):
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"wall_time": round(wall_time, 3), "peak_rss_mb": round(peak_rss_kb / 1024, 1), "error": error}))
+"""
+
+
+def runScenario(scenario, device_count, args):
+    devices = generateFleet(device_count, args.duplicate_ratio, args.buildings)
+    mock = MockXIQ(devices, latency=args.latency, error_rate_429=args.error_rate_429,
+                   error_rate_5xx=args.error_rate_5xx, buildings=args.buildings, rate_limit=args.rate_limit, rate_window=args.rate_window)
+    del devices
+    url = mock.start()
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            completed = subprocess.run([sys.executable, "-c", CHILD, REPO_DIR, scenario, url, state_dir, str(args.page_concurrency)],
+                                       capture_output=True, text=True, cwd=state_dir)
+    finally:
+        mock.stop()
+    lines = completed.stdout.strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "no result"}
+    result.update({
+        "scenario": scenario,
+        "devices": device_count,
+        "requests": sum(mock.requests.values()),
+        "requests_by_endpoint": dict(mock.requests),
+        "status_codes": {str(status): count for status, count in mock.status_codes.items()},
+        "response_bytes": mock.bytes_sent
+    })
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark XIQ_Duplicate_AP_Check.py and the XIQ client against a local mock XIQ")
+    parser.add_argument('--sizes', default="10000,100000,500000", help="comma separated fleet sizes")
+    parser.add_argument('--scenarios', default="collect,script", help="collect (XIQ.iterDevices only) and/or script (full check)")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--buildings', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every mock response")
+    parser.add_argument('--error-rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate-5xx', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0, help="calls the mock allows per rate window, 0 for no limit")
+    parser.add_argument('--rate-window', type=float, default=60.0)
+    parser.add_argument('--page-concurrency', type=int, default=5)
+    parser.add_argument('--output', default="benchmark_results.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    results = []
+    for device_count in (int(size) for size in args.sizes.split(',')):
+        for scenario in args.scenarios.split(','):
+            result = runScenario(scenario, device_count, args)
+            results.append(result)
+            print(f"{scenario:8} {device_count:>8} devices  {result.get('wall_time', '-'):>8}s  "
+                  f"{result['requests']:>6} requests  {result.get('peak_rss_mb', '-'):>7} MB"
+                  + (f"  error: {result['error']}" if result.get('error') else ""))
+    with open(args.output, "w") as FH:
+        json.dump({"created": time.time(), "settings": vars(args), "results": results}, FH, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,19 @@
+from app.batch import BatchExecutor, ACCEPTED
+
+
+def test_accepted_chunks_are_kept_apart():
+    answers = {1: 200, 3: 202, 5: None}
+
+    def call(chunk):
+        status = answers[chunk[0]]
+        if status is None:
+            raise RuntimeError("refused")
+        return status
+
+    chunks = []
+    result = BatchExecutor(chunk_size=2, max_workers=2).run(call, [1, 2, 3, 4, 5, 6], lambda chunk, error: chunks.append((chunk, error)))
+    # a 202 only means XIQ will make the change later, so those ids have not changed yet
+    assert result.succeeded == [1, 2]
+    assert result.accepted == [3, 4]
+    assert set(result.failed) == {5, 6}
+    assert sorted(chunks) == [([1, 2], None), ([3, 4], ACCEPTED), ([5, 6], "refused")]
@@ -0,0 +1,78 @@
+import random
+import time
+import pytest
+from app.duplicates import DuplicateIndex, HostnameRules
+
+
+## Fleet with shared hostnames, offline and unmanaged devices and unknown connection states
+def makeFleet(device_count, seed=7):
+    rng = random.Random(seed)
+    hostnames = device_count * 9 // 10
+    devices = []
+    for device_id in range(device_count):
+        devices.append({
+            "id": 100000 + device_id,
+            "hostname": f"AP-{rng.randrange(hostnames):07d}",
+            "connected": rng.choice((True, True, True, False, None)),
+            "device_admin_state": rng.choice(("MANAGED", "MANAGED", "MANAGED", "UNMANAGED"))
+        })
+    return devices
+
+
+## The selection of the original script: pandas rows with a duplicated hostname, then per hostname in order
+## of first appearance the managed devices that are not connected
+def pandasCandidates(devices):
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame(devices)
+    duplicated_rows = df[df.duplicated(subset='hostname', keep=False)]
+    device_ids = []
+    for device_name in duplicated_rows['hostname'].unique():
+        filt = (duplicated_rows['hostname'] == device_name) & \
+               ((duplicated_rows['connected'] == False) & (duplicated_rows['device_admin_state'] == 'MANAGED'))
+        device_ids.extend(duplicated_rows.loc[filt, 'id'].astype(int).tolist())
+    return set(duplicated_rows['hostname'].unique()), device_ids
+
+
+def test_matches_the_pandas_selection():
+    devices = makeFleet(5000)
+    hostnames, candidate_ids = pandasCandidates(devices)
+    duplicate_index = DuplicateIndex(devices)
+    assert {name for name, group in duplicate_index.duplicateGroups()} == hostnames
+    assert duplicate_index.candidateIds() == candidate_ids
+
+
+def test_devices_without_hostname_are_not_duplicates():
+    devices = [{"id": 1, "hostname": None, "connected": False, "device_admin_state": "MANAGED"},
+               {"id": 2, "hostname": "", "connected": False, "device_admin_state": "MANAGED"},
+               {"id": 3, "hostname": "AP", "connected": True, "device_admin_state": "MANAGED"}]
+    assert not DuplicateIndex(devices).hasDuplicates()
+
+
+def test_keys_and_hostname_rules_merge_groups():
+    devices = [{"id": 1, "hostname": "AP-01", "serial_number": "S1", "mac_address": "aa:bb:cc:00:00:01", "connected": True, "device_admin_state": "MANAGED"},
+               {"id": 2, "hostname": "ap-01-old", "serial_number": "S2", "mac_address": "AABBCC000002", "connected": False, "device_admin_state": "MANAGED"},
+               {"id": 3, "hostname": "Lobby", "serial_number": "s1", "mac_address": "AA-BB-CC-00-00-03", "connected": False, "device_admin_state": "MANAGED"},
+               {"id": 4, "hostname": "Solo", "serial_number": "S4", "mac_address": "aabb.cc00.0003", "connected": False, "device_admin_state": "MANAGED"}]
+    duplicate_index = DuplicateIndex(devices, keys=("hostname", "serial_number", "mac_address"),
+                                     hostname_rules=HostnameRules(ignore_case=True, strip_patterns=[r"[-_.]old$"]))
+    groups = duplicate_index.mergedGroups()
+    assert len(groups) == 1
+    assert [device['id'] for device in groups[0].devices] == [1, 2, 3, 4]
+    assert duplicate_index.candidateIds() == [2, 3, 4]
+
+
+def buildTime(devices):
+    best = None
+    for attempt in range(2):
+        start = time.perf_counter()
+        DuplicateIndex(devices).candidateIds()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def test_scales_linearly():
+    small = makeFleet(100_000)
+    large = makeFleet(400_000)
+    # four times the devices takes about four times as long, a quadratic engine would take sixteen
+    assert buildTime(large) / buildTime(small) < 8
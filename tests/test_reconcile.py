@@ -0,0 +1,97 @@
+import time
+from app.inventory import CompactInventory
+from app.reconcile import reconcile
+from app.expiry_store import JsonExpiryStore, SqliteExpiryStore
+
+NOW = 1_000_000
+
+
+def tracked(device_id, expire_at):
+    return {"device_id": device_id, "added_time": expire_at - 100, "expire_at": expire_at}
+
+
+## The tracked ids and expired ids of some store entries, as ExpiryStore.trackedIds and expired return them
+def split(entries, now=NOW):
+    return [entry['device_id'] for entry in entries], [entry['device_id'] for entry in entries if entry['expire_at'] <= now]
+
+
+def test_expired_vanished_and_kept():
+    entries = [tracked(1, NOW - 1), tracked(2, NOW), tracked(3, NOW + 1), tracked(4, NOW - 1), tracked(5, NOW + 1)]
+    result = reconcile(*split(entries), [1, 2, 3, 10], [], [])
+    # expire_at equal to now has expired, devices missing from XIQ vanish whether they expired or not
+    assert result.expired == [1, 2]
+    assert result.vanished == [4, 5]
+    assert result.kept == [3]
+
+
+def test_ccg_members_untracked_and_candidates():
+    entries = [tracked(1, NOW - 1), tracked(2, NOW + 1)]
+    result = reconcile(*split(entries), {1, 2, 3, 4, 5}, [1, 2, 3], [3, 4, 5])
+    # the expired device is deleted, so it is no longer a CCG member
+    assert result.ccg_ids == [2, 3]
+    assert result.untracked == [3]
+    assert result.in_ccg == [3]
+    assert result.new == [4, 5]
+
+
+def test_empty_inputs():
+    result = reconcile([], [], [], [], [])
+    assert result == ([], [], [], [], [], [], [])
+
+
+def test_live_ids_from_an_inventory():
+    inventory = CompactInventory()
+    inventory.extend({"id": device_id, "hostname": f"AP-{device_id}", "connected": True, "device_admin_state": "MANAGED"}
+                     for device_id in (1, 2))
+    result = reconcile(*split([tracked(1, NOW - 1), tracked(3, NOW + 1)]), inventory, [], [])
+    assert result.expired == [1]
+    assert result.vanished == [3]
+
+
+def test_live_ids_from_a_generator():
+    result = reconcile(*split([tracked(1, NOW + 1), tracked(2, NOW + 1)]), (device_id for device_id in [2]), [], [])
+    assert result.vanished == [1]
+    assert result.kept == [2]
+
+
+def test_large_inputs():
+    device_count = 500_000
+    tracked_count = 150_000
+    live_ids = list(range(device_count))
+    # every third tracked device has expired, every fifth is gone from XIQ
+    entries = [tracked(device_id if n % 5 else device_count + n, NOW - 1 if n % 3 == 0 else NOW + 1)
+               for n, device_id in enumerate(range(0, tracked_count * 2, 2))]
+    ccg_ids = [entry['device_id'] for entry in entries] + list(range(1, 20_001, 2))
+    candidate_ids = list(range(1, 100_001, 2))
+
+    tracked_ids, expired_ids = split(entries)
+    start = time.perf_counter()
+    result = reconcile(tracked_ids, expired_ids, live_ids, ccg_ids, candidate_ids)
+    duration = time.perf_counter() - start
+
+    vanished = {entry['device_id'] for n, entry in enumerate(entries) if n % 5 == 0}
+    expired = {entry['device_id'] for n, entry in enumerate(entries) if n % 3 == 0 and n % 5}
+    assert set(result.vanished) == vanished
+    assert set(result.expired) == expired
+    assert len(result.kept) == tracked_count - len(vanished) - len(expired)
+    assert len(result.ccg_ids) == len(ccg_ids) - len(expired)
+    # vanished devices are no longer tracked, and the odd ids were never tracked
+    assert set(result.untracked) == vanished | set(range(1, 20_001, 2))
+    assert set(result.in_ccg) == set(range(1, 20_001, 2))
+    assert len(result.new) == len(candidate_ids) - len(result.in_ccg)
+    # one pass over each list, a quadratic reconciliation takes hours at this size
+    assert duration < 10
+
+
+def test_expiry_stores_agree(tmp_path):
+    entries = [tracked(1, NOW - 5), tracked(2, NOW), tracked(3, NOW + 5), tracked(4, NOW + 10)]
+    for store in (JsonExpiryStore(str(tmp_path / "unmanaged.json")), SqliteExpiryStore(str(tmp_path / "unmanaged.db"))):
+        store.add(entries)
+        assert store.trackedIds() == {1, 2, 3, 4}
+        assert store.expired(NOW) == [1, 2]
+        assert store.nextExpiry() == NOW - 5
+        # the service skips devices that have expired already, they are left to the next scan
+        assert store.nextExpiry(after=NOW) == NOW + 5
+        store.remove([1, 2, 3, 4])
+        assert store.nextExpiry() is None
+        store.close()